@@ -5,6 +5,8 @@ from pathlib import Path
 import json
 from src import memory_based, sort_based, dataset
 from src.document import Document
+from src.json_stream import iter_json_entries
+from src.crawler import Crawler
 import pprint
 import pickle
 from timeit import timeit
@@ -22,22 +24,70 @@ def main():
 
 def read_docs():
     with open('docs.json', 'r') as sin:
-        return json.load(sin, object_hook=lambda d: Document(None, d))
+        yield from iter_json_entries(sin, object_hook=lambda d: Document(None, d))
 
 
 def generate_docs():
-    # files = glob('**/*.(epub|pdf)', root_dir='/Volumes/storeA/books')
-    docs = []
-    for p in (p for p in Path(BOOKS_ROOT).glob("**/*") if p.suffix in {".pdf", ".epub"}):
-        d = Document(p)
-        docs.append(d)
-
-    with open('docs.json', 'w') as sout:
-        # use default=vars to utilize @property __dict__ of the custom classes
-        json.dump(docs, sout, sort_keys=True, indent=2, default=vars)
+    ''' Update docs.json with the books added, changed or removed since
+        the previous run. Books keep their ids while their path exists and
+        ids of removed books are never given again, notes and favourites
+        are stored by id.
+    '''
+    crawler = Crawler(BOOKS_ROOT, 'docs.manifest.json', suffixes={'.pdf', '.epub'})
+    changes = crawler.rescan()
+    print('- crawled:', changes)
+
+    def entry(path, doc_id):
+        return {'id': doc_id, 'name': Path(path).stem, 'path': path,
+                'size': changes.files[path][0]}
+
+    def write_entry(doc):
+        nonlocal first
+        # same layout as json.dump(docs, indent=2) of the whole list
+        sout.write(('[\n  ' if first else ',\n  ')
+                   + json.dumps(doc, sort_keys=True, indent=2).replace('\n', '\n  '))
+        first = False
+
+    # docs.json is streamed into docs.json.part: removed books are left
+    # out, changed ones rewritten in place, added ones appended with new
+    # ids, so the entries stay sorted by id
+    removed = set(changes.removed)
+    updated = set(changes.changed) | set(changes.added)
+    existing = set()
+    last_id = 0
+    first = True
+    with open('docs.json.part', 'w') as sout:
+        if os.path.exists('docs.json'):
+            with open('docs.json', 'r') as sin:
+                for doc in iter_json_entries(sin):
+                    last_id = max(last_id, doc['id'])
+                    if doc['path'] in removed:
+                        continue
+                    if doc['path'] in updated:
+                        # added books can be listed already when the
+                        # previous run failed to commit the manifest
+                        existing.add(doc['path'])
+                        doc = entry(doc['path'], doc['id'])
+                    write_entry(doc)
+
+        # the counter of the manifest lags behind when the previous run failed
+        # to commit it after writing docs.json
+        next_id = max(changes.state.get('next_id', 1), last_id + 1)
+        for path in changes.added:
+            if path not in existing:
+                write_entry(entry(path, next_id))
+                next_id += 1
+        sout.write('[]' if first else '\n]')
+    os.replace('docs.json.part', 'docs.json')
+
+    changes.state['next_id'] = next_id
+    crawler.commit(changes)
 
 
 def construct_index_1(docs):
+    # read_docs streams the file once, every timed run needs all the docs
+    docs = list(docs)
+
     def bar():
         index = {}
         for d in docs:
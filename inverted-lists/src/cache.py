@@ -0,0 +1,220 @@
+''' In-process caches of query results and decoded postings lists.
+
+    Results are kept in LRU order up to a total size in bytes. Every entry
+    remembers the generation of the index files it was computed from, the
+    (inode, mtime, size) of each of them, so results of an index that has
+    been rebuilt since are never returned.
+
+    Decoded postings lists of frequently queried terms are kept with the
+    GreedyDual-Size-Frequency policy: a list gets the priority
+    L + frequency * cost / size, where the cost of decoding grows with the
+    list length and L is the priority of the last evicted list. Evicting
+    the lowest priority first favours lists that are accessed often and
+    save a lot of decoding per byte they hold, and the growing L ages out
+    lists that stopped being used.
+'''
+import os
+import sys
+import heapq
+import threading
+from itertools import count
+from collections import OrderedDict
+
+from .query import parse_query
+
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+# Approximate memory held by a single doc id or (doc_id, score) result.
+RESULT_ENTRY_SIZE = 64
+MAX_POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+# Lists are decoded into the cache from their second access on, one-off
+# terms are read lazily from the inverted file.
+POSTINGS_ADMISSION_COUNT = 2
+# Max number of terms whose access counts are tracked before caching.
+MAX_TRACKED_TERMS = 64 * 1024
+# Cost of fetching a list regardless of its length, in postings.
+FETCH_COST = 64
+# Memory held by a cached list besides its arrays.
+CACHED_LIST_OVERHEAD = 256
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        ''' Return the cached results for key, or None when there are none
+            for this generation of the index.
+        '''
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, results):
+        results = tuple(results)
+        size = result_size(results)
+        with self.lock:
+            self.__remove(key)
+            if size > self.max_bytes:
+                return results
+            self.entries[key] = (generation, results, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.__remove(next(iter(self.entries)))
+        return results
+
+    def cached(self, key, paths, compute):
+        ''' Return the results for key, calling compute() on a miss.
+        '''
+        generation = index_generation(paths)
+        results = self.get(key, generation)
+        if results is None:
+            results = self.put(key, generation, compute())
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class PostingsCache:
+
+    def __init__(self, max_bytes=MAX_POSTINGS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # key -> [generation, value, size, frequency, cost per byte, priority]
+        self.entries = {}
+        self.queue = []
+        self.order = count()
+        self.clock = 0
+        self.size = 0
+        self.accesses = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation, length, decode):
+        ''' Return the decoded list for key, calling decode() to fill the
+            cache once the key has been requested often enough. Returns
+            None when the list should be read lazily instead. The length
+            of the list in postings estimates the decoding cost.
+        '''
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] == generation:
+                self.hits += 1
+                entry[3] += 1
+                self.__prioritize(key, entry)
+                return entry[1]
+
+            self.misses += 1
+            if entry is not None:
+                self.__remove(key)
+            accesses = self.accesses.get(key, 0) + 1
+            if accesses < POSTINGS_ADMISSION_COUNT:
+                if len(self.accesses) >= MAX_TRACKED_TERMS:
+                    self.accesses.clear()
+                self.accesses[key] = accesses
+                return None
+            self.accesses.pop(key, None)
+            # doc ids and freqs take at least 8 bytes per posting
+            if CACHED_LIST_OVERHEAD + 8 * length > self.max_bytes:
+                return None
+
+        value = decode()
+        size = CACHED_LIST_OVERHEAD + sum(u.itemsize * len(u) for u in value if u is not None)
+
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+            entry = [generation, value, size, accesses, (FETCH_COST + length) / size, 0]
+            self.entries[key] = entry
+            self.size += size
+            self.__prioritize(key, entry)
+            self.__evict()
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.queue = []
+            self.accesses.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+    def __prioritize(self, key, entry):
+        entry[5] = self.clock + entry[3] * entry[4]
+        heapq.heappush(self.queue, (entry[5], next(self.order), key))
+        # drop the stale items left behind by earlier priorities
+        if len(self.queue) > 4 * len(self.entries) + 64:
+            self.queue = [(u[5], next(self.order), k) for (k, u) in self.entries.items()]
+            heapq.heapify(self.queue)
+
+    def __evict(self):
+        while self.size > self.max_bytes:
+            (priority, _, key) = heapq.heappop(self.queue)
+            entry = self.entries.get(key, None)
+            # stale queue items of re-prioritized or removed lists
+            if entry is None or entry[5] != priority:
+                continue
+            self.clock = priority
+            self.__remove(key)
+
+    def __remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[2]
+
+
+def index_generation(paths):
+    ''' Identify the current version of the index files.
+    '''
+    generation = []
+    for path in paths:
+        stat = os.stat(path)
+        generation.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return tuple(generation)
+
+
+def normalize_query(query):
+    ''' Queries that parse to the same tree share a cache entry, so extra
+        spaces or the case of terms do not matter.
+    '''
+    return repr(parse_query(query))
+
+
+def result_size(results):
+    return sys.getsizeof(results) + len(results) * RESULT_ENTRY_SIZE
+
+
+result_cache = ResultCache()
+postings_cache = PostingsCache()
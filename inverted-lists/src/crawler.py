@@ -0,0 +1,112 @@
+''' Incremental scanning of a directory tree.
+
+    Directories are listed in parallel by a pool of threads, which mostly
+    wait on the file system, so slow network storage is listed many
+    directories at a time. The (size, mtime, inode) of every file found
+    is kept in a JSON manifest and a rescan reports only the files added,
+    changed or removed since the previous one. The manifest is replaced
+    only once the caller commits the changes, after acting on them, so a
+    failure in between reports the same changes again on the next rescan.
+    The manifest also keeps a state dictionary of the caller, committed
+    along with the files.
+'''
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+SCAN_WORKERS = 32
+
+
+class Changes:
+
+    def __init__(self, added, changed, removed, files, state):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        # the scan the changes come from and the state of the caller, both
+        # saved to the manifest by Crawler.commit
+        self.files = files
+        self.state = state
+
+    def __repr__(self):
+        return (f'Changes(added={len(self.added)}, changed={len(self.changed)}, '
+                f'removed={len(self.removed)})')
+
+
+class Crawler:
+
+    def __init__(self, root, manifest_path, suffixes=None, workers=SCAN_WORKERS):
+        self.root = root
+        self.manifest_path = manifest_path
+        self.suffixes = suffixes
+        self.workers = workers
+
+    def rescan(self):
+        ''' Scan the tree and compare it with the manifest of the last
+            committed scan. Returns the Changes as sorted lists of paths,
+            the manifest is left as it is until they are committed.
+        '''
+        (previous, state) = self.__load_manifest()
+        current = self.scan()
+
+        added = sorted(u for u in current if u not in previous)
+        removed = sorted(u for u in previous if u not in current)
+        changed = sorted(u for (u, v) in current.items() if u in previous and previous[u] != v)
+
+        return Changes(added, changed, removed, current, state)
+
+    def commit(self, changes):
+        ''' Replace the manifest with the scan and the state of the changes.
+        '''
+        with open(self.manifest_path + '.part', 'w') as fout:
+            json.dump({'files': changes.files, 'state': changes.state}, fout)
+        os.replace(self.manifest_path + '.part', self.manifest_path)
+
+    def scan(self):
+        ''' Map the path of every matching file under root to its
+            (size, mtime in ns, inode).
+        '''
+        files = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = {executor.submit(self.__list_dir, self.root)}
+            while pending:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (dir_files, subdirs) = future.result()
+                    files.update(dir_files)
+                    pending.update(executor.submit(self.__list_dir, u) for u in subdirs)
+        return files
+
+    def __list_dir(self, path):
+        files = {}
+        subdirs = []
+        try:
+            entries = list(os.scandir(path))
+        except (PermissionError, FileNotFoundError):
+            return (files, subdirs)
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and self.__matches(entry.name):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            except FileNotFoundError:
+                # removed while being scanned
+                continue
+        return (files, subdirs)
+
+    def __matches(self, name):
+        return self.suffixes is None or os.path.splitext(name)[1].lower() in self.suffixes
+
+    def __load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return ({}, {})
+        with open(self.manifest_path, 'r') as fin:
+            manifest = json.load(fin)
+        # manifests of earlier versions only map the files
+        if 'files' not in manifest:
+            manifest = {'files': manifest, 'state': {}}
+        files = {k: tuple(v) for (k, v) in manifest['files'].items()}
+        return (files, manifest['state'])
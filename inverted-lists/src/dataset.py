@@ -1,17 +1,40 @@
 import os
 import abc
-import json
+import heapq
+import pickle
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from .cache import result_cache, normalize_query
+from .query import make_fuzzy
+from .ranking import collection_stats
+from .suggest import complete
+from .doc_store import write_doc_store, open_doc_store
+from .json_stream import iter_json_entries
+from .extraction import ExtractionCache, extract_texts, EXTRACTION_TIMEOUT
+from .metadata import write_metadata, open_metadata
 
 DATA_BASE_DIR = '_tmp'
+# Texts extracted from the files of all datasets, by content digest.
+EXTRACTION_CACHE_DIR = f'{DATA_BASE_DIR}/extracted'
+# Entry fields shown with query results, kept in the metadata columns.
+METADATA_FIELDS = ['name', 'created', 'size', 'path']
 
 
 class Dataset:
+    ''' With shards > 1 documents are partitioned by doc id over that many
+        independent indexes. Shards are built in parallel processes and
+        queries fan out over a process pool. Ranked queries send the doc
+        count, total length and term dfs of all shards along, so every
+        shard scores as the single index would.
+    '''
 
-    def __init__(self, name, delegate, subdir=None):
+    def __init__(self, name, delegate, subdir=None, shards=1):
         self.name = name
         self.delegate = delegate
         self.subdir = subdir
+        self.shards = shards
+        self.__method = None
 
         # ensure data dir exists
         Path(self.base_subdir).mkdir(parents=True, exist_ok=True)
@@ -19,38 +42,145 @@ class Dataset:
     def collect_documents(self):
         self.delegate.collect_documents(self.docs_file_path)
 
-    def create_inverted_file(self):
+    def extract_texts(self, paths, workers=None, timeout=EXTRACTION_TIMEOUT):
+        ''' Yield (path, text) of the files as the delegate extracts them in
+            parallel, texts of files extracted before are read from the
+            cache shared by all datasets.
+        '''
+        cache = ExtractionCache(EXTRACTION_CACHE_DIR)
+        return extract_texts(self.delegate, paths, cache, workers, timeout)
 
-        method = self.delegate.strategy(
-            self.lexicon_file_path,
-            self.inverted_file_path,
-            self.temp_file_path)
+    def create_inverted_file(self):
+        write_doc_store(self.doc_store_file_path, self.entry_gen)
+        write_metadata(self.metadata_file_path, self.entry_gen, METADATA_FIELDS)
 
         docs_gen = self.delegate.docs_gen(self.entry_gen)
-        method.create_invreted_file(docs_gen)
+        if self.shards == 1:
+            self.method.create_invreted_file(docs_gen)
+            return
+
+        # partition the documents first, each shard is then built by a
+        # process of its own
+        files = [open(self.shard_file_path(u, '.docs'), 'wb') for u in range(self.shards)]
+        for doc in docs_gen:
+            pickle.dump(doc, files[doc.id % self.shards])
+        for u in files:
+            u.close()
+
+        with ProcessPoolExecutor(min(self.shards, os.cpu_count())) as executor:
+            futures = [executor.submit(build_shard, self.delegate.strategy,
+                                       *self.shard_index_paths(u),
+                                       self.shard_file_path(u, '.docs'))
+                       for u in range(self.shards)]
+            for u in futures:
+                u.result()
+
+    def search(self, query, fuzzy=True):
+        ''' Ids of the documents matching the query. When nothing matches,
+            the query is retried with fuzzy terms to get past typos.
+        '''
+        results = self.__cached('search', query, self.__retrieve_docs)
+        if not results and fuzzy:
+            results = self.__cached('search', make_fuzzy(query), self.__retrieve_docs)
+        return list(results)
+
+    def rank(self, query, k=20, fuzzy=True):
+        results = self.__cached(('rank', k), query, lambda u: self.__rank(u, k))
+        if not results and fuzzy:
+            results = self.__cached(('rank', k), make_fuzzy(query), lambda u: self.__rank(u, k))
+        return list(results)
+
+    def __cached(self, kind, query, compute):
+        key = (kind, self.inverted_file_path, normalize_query(query))
+        return result_cache.cached(key, self.index_file_paths, lambda: compute(query))
+
+    def __retrieve_docs(self, query):
+        if self.shards == 1:
+            return self.method.retrieve_docs(query)
+        return list(heapq.merge(*self.__fan_out(search_shard, query)))
+
+    def __rank(self, query, k):
+        if self.shards == 1:
+            return self.method.rank(query, k)
+        shards = [self.delegate.strategy(*self.shard_index_paths(u)) for u in range(self.shards)]
+        collection = collection_stats(query, shards)
+        results = [u for shard in self.__fan_out(rank_shard, query, k, collection) for u in shard]
+        return sorted(results, key=lambda u: (-u[1], u[0]))[:k]
 
-    def search(self, query):
-        method = self.delegate.strategy(
-            self.lexicon_file_path,
-            self.inverted_file_path,
-            self.temp_file_path)
+    def __fan_out(self, function, *args):
+        executor = query_executor()
+        futures = [executor.submit(function, self.delegate.strategy,
+                                   *self.shard_index_paths(u), *args)
+                   for u in range(self.shards)]
+        return [u.result() for u in futures]
 
-        return method.retrieve_docs(query)
+    def suggest(self, prefix, k=10):
+        ''' Completions of a prefix as (term, df) pairs, read from the
+            files written along the index only.
+        '''
+        dfs = {}
+        for shard in range(self.shards):
+            suggestions = complete(self.shard_file_path(shard, '.sug'),
+                                   self.shard_file_path(shard, '.lex'), prefix, k)
+            for (term, df) in suggestions:
+                dfs[term] = dfs.get(term, 0) + df
+        return sorted(dfs.items(), key=lambda u: (-u[1], u[0]))[:k]
+
+    @property
+    def method(self):
+        ''' Strategy instance reused between queries.
+        '''
+        if self.__method is None:
+            self.__method = self.delegate.strategy(
+                self.lexicon_file_path,
+                self.inverted_file_path,
+                self.temp_file_path)
+        return self.__method
+
+    @property
+    def cache_stats(self):
+        return result_cache.stats()
 
     def find_by_id(self, id):
-        with open(self.docs_file_path, 'r') as fin:
-            entries = json.load(fin)
-            for u in entries:
-                if u['id'] == id:
-                    return u
+        ''' Read the entry from the doc store, unless the documents were
+            collected again after it was written.
+        '''
+        if self.__is_current(self.doc_store_file_path):
+            return open_doc_store(self.doc_store_file_path).get(id)
+
+        for u in self.entry_gen:
+            if u['id'] == id:
+                return u
         return None
 
+    def fetch_fields(self, doc_ids, fields=None):
+        ''' Entries of the given docs holding the requested METADATA_FIELDS
+            only, None for unknown ids. Read from the metadata columns
+            unless the documents were collected again after they were
+            written.
+        '''
+        fields = fields if fields is not None else METADATA_FIELDS
+        if self.__is_current(self.metadata_file_path):
+            return open_metadata(self.metadata_file_path).rows(doc_ids, fields)
+
+        entries = [self.find_by_id(u) for u in doc_ids]
+        return [{'id': u['id'], **{f: u.get(f, None) for f in fields}} if u is not None else None
+                for u in entries]
+
+    def __is_current(self, path):
+        ''' Whether a file derived from the docs file is newer than it.
+        '''
+        if not os.path.exists(path):
+            return False
+        return os.stat(path).st_mtime_ns >= os.stat(self.docs_file_path).st_mtime_ns
+
     @property
     def entry_gen(self):
+        ''' Stream the entries of the docs file, either a JSON array or
+            JSON Lines, one at a time.
+        '''
         with open(self.docs_file_path, 'r') as fin:
-            entries = json.load(fin)
-        for u in entries:
-            yield u
+            yield from iter_json_entries(fin)
 
     @property
     def base_subdir(self):
@@ -63,17 +193,77 @@ class Dataset:
     def docs_file_path(self):
         return f'{self.base_subdir}/{self.name}.json'
 
+    @property
+    def metadata_file_path(self):
+        return f'{self.base_subdir}/{self.name}.col'
+
+    @property
+    def doc_store_file_path(self):
+        return f'{self.base_subdir}/{self.name}.dst'
+
+    def shard_file_path(self, shard, extension):
+        if self.shards == 1:
+            return f'{self.base_subdir}/{self.name}{extension}'
+        return f'{self.base_subdir}/{self.name}.{shard:03d}{extension}'
+
+    def shard_index_paths(self, shard):
+        return (self.shard_file_path(shard, '.lex'),
+                self.shard_file_path(shard, '.inf'),
+                self.shard_file_path(shard, '.tmp'))
+
     @property
     def inverted_file_path(self):
-        return f'{self.base_subdir}/{self.name}.inf'
+        return self.shard_file_path(0, '.inf')
 
     @property
     def lexicon_file_path(self):
-        return f'{self.base_subdir}/{self.name}.lex'
+        return self.shard_file_path(0, '.lex')
+
+    @property
+    def index_file_paths(self):
+        return [u for shard in range(self.shards) for u in self.shard_index_paths(shard)[:2]]
 
     @property
     def temp_file_path(self):
-        return f'{self.base_subdir}/{self.name}.tmp'
+        return self.shard_file_path(0, '.tmp')
+
+
+def build_shard(strategy, lexicon_path, inverted_file_path, temp_file_path, docs_path):
+    ''' Build the index of a shard from its partition of the documents,
+        run in a worker process.
+    '''
+    def docs_gen():
+        with open(docs_path, 'rb') as fin:
+            while True:
+                try:
+                    yield pickle.load(fin)
+                except EOFError:
+                    break
+
+    method = strategy(lexicon_path, inverted_file_path, temp_file_path)
+    method.create_invreted_file(docs_gen())
+    os.remove(docs_path)
+
+
+def search_shard(strategy, lexicon_path, inverted_file_path, temp_file_path, query):
+    return strategy(lexicon_path, inverted_file_path, temp_file_path).retrieve_docs(query)
+
+
+def rank_shard(strategy, lexicon_path, inverted_file_path, temp_file_path, query, k, collection):
+    return strategy(lexicon_path, inverted_file_path, temp_file_path).rank(query, k, collection)
+
+
+def query_executor():
+    ''' Process pool shared by the queries of all sharded datasets. Index
+        files stay open in the workers between queries.
+    '''
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = ProcessPoolExecutor(os.cpu_count())
+    return _query_executor
+
+
+_query_executor = None
 
 
 class DatasetDelegateInterface(metaclass=abc.ABCMeta):
@@ -0,0 +1,81 @@
+''' Binary store of the dataset entries, looked up by document id.
+
+        magic
+        header  (smallest id, table length, table offset)
+        records of (uint32 length, JSON of the entry), one per entry
+        table   of uint64 record offsets indexed by id - smallest id,
+                0 for ids without an entry
+
+    A lookup reads one table slot and one record through mmap, so it costs
+    the same however many entries the store holds. Ids are expected to be
+    dense, the table has a slot for every id between the smallest and the
+    largest one.
+'''
+import os
+import mmap
+import json
+import struct
+from array import array
+
+from .file_cache import open_cached
+
+MAGIC = b'DST\x01'
+# smallest id, table length, table offset
+HEADER_FORMAT = '=QQQ'
+RECORD_HEADER_FORMAT = '=I'
+
+
+def write_doc_store(path, entries):
+    ''' Persist the entries, dictionaries holding an 'id', at path.
+    '''
+    ids = array('Q')
+    offsets = array('Q')
+    with open(path + '.part', 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(bytes(struct.calcsize(HEADER_FORMAT)))
+        for entry in entries:
+            record = json.dumps(entry).encode()
+            ids.append(entry['id'])
+            offsets.append(fout.tell())
+            fout.write(struct.pack(RECORD_HEADER_FORMAT, len(record)))
+            fout.write(record)
+
+        min_id = min(ids, default=0)
+        table = array('Q', bytes(8 * (max(ids, default=-1) - min_id + 1)))
+        for (doc_id, offset) in zip(ids, offsets):
+            table[doc_id - min_id] = offset
+        table_offset = fout.tell()
+        fout.write(table.tobytes())
+
+        fout.seek(len(MAGIC))
+        fout.write(struct.pack(HEADER_FORMAT, min_id, len(table), table_offset))
+    os.replace(path + '.part', path)
+
+
+class DocStore:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a doc store file.')
+        (self.min_id, table_length, table_offset) = struct.unpack_from(
+            HEADER_FORMAT, self.data, len(MAGIC))
+        size = table_length * array('Q').itemsize
+        self.table = memoryview(self.data)[table_offset:table_offset + size].cast('Q')
+
+    def get(self, doc_id):
+        ''' The entry with the given id, None when there is none.
+        '''
+        slot = doc_id - self.min_id
+        if not 0 <= slot < len(self.table) or self.table[slot] == 0:
+            return None
+        pos = self.table[slot]
+        (length,) = struct.unpack_from(RECORD_HEADER_FORMAT, self.data, pos)
+        pos += struct.calcsize(RECORD_HEADER_FORMAT)
+        return json.loads(self.data[pos:pos + length])
+
+
+def open_doc_store(path):
+    return open_cached(path, DocStore)
@@ -1,5 +1,5 @@
 import base64
-from flask import Blueprint, render_template, redirect, request, url_for
+from flask import Blueprint, render_template, redirect, request, url_for, jsonify
 
 from src.dataset import Dataset
 from src.endpoint.extensions import db
@@ -11,6 +11,10 @@ from sqlalchemy import select
 
 home = Blueprint('home', __name__)
 
+# Datasets whose lexicons feed the query suggestions, as (subdir, name).
+SUGGEST_DATASETS = [('storea_book_set', 'books')]
+SUGGESTIONS = 8
+
 
 @home.route('/', methods=['GET'])
 def home_page():
@@ -36,6 +40,21 @@ def home_page():
         return render_template('home/index_results.html', q=q, entries=entries)
 
 
+@home.route('/suggest', methods=['GET'])
+def suggest():
+    q = request.args.get('q', default='').strip()
+    if not q:
+        return jsonify([])
+
+    dfs = {}
+    for (subdir, name) in SUGGEST_DATASETS:
+        ds = Dataset(name, None, subdir)
+        for (term, df) in ds.suggest(q, SUGGESTIONS):
+            dfs[term] = dfs.get(term, 0) + df
+    terms = sorted(dfs.keys(), key=lambda u: (-dfs[u], u))
+    return jsonify(terms[:SUGGESTIONS])
+
+
 @home.route('/entry/<src>', methods=['GET'])
 def details(src):
     src_decoded = base64.urlsafe_b64decode(bytes(src, 'utf-8')).decode()
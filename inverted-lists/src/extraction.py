@@ -0,0 +1,228 @@
+''' Parallel text extraction with a content addressed cache.
+
+    Delegates extract the text of files in a pool of processes, every file
+    with a time limit. Extracted texts are stored under the SHA-256 of the
+    file content, so a book is extracted once whatever its path or the
+    dataset it belongs to. The digests are remembered by (size, mtime,
+    inode) of the files, unchanged files are not read again to be hashed.
+'''
+import os
+import json
+import time
+import signal
+import hashlib
+import threading
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Seconds a delegate may spend on the text of a single file.
+EXTRACTION_TIMEOUT = 120
+# Seconds past the time limit after which the parent kills a delegate that
+# did not stop on the alarm.
+TIMEOUT_GRACE = 10
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+class ExtractionCache:
+    ''' Extracted texts stored as {cache_dir}/{digest[:2]}/{digest}.txt
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.digests_path = f'{cache_dir}/digests.json'
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # loaded on first use, workers only read and write texts
+        self.digests = None
+
+    def get(self, digest):
+        path = self.__text_path(digest)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as fin:
+            return fin.read()
+
+    def put(self, digest, text):
+        path = self.__text_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.part', 'w', encoding='utf-8') as fout:
+            fout.write(text)
+        os.replace(path + '.part', path)
+
+    def known_digest(self, path):
+        ''' Digest of the file content computed earlier, None when the file
+            changed since or was never hashed.
+        '''
+        known = self.__load_digests().get(path, None)
+        if known is None or not os.path.exists(path) or known[:3] != list(file_version(path)):
+            return None
+        return known[3]
+
+    def remember_digest(self, path, version, digest):
+        with self.lock:
+            self.__load_digests()[path] = [*version, digest]
+
+    def save_digests(self):
+        with self.lock:
+            with open(self.digests_path + '.part', 'w') as fout:
+                json.dump(self.__load_digests(), fout)
+            os.replace(self.digests_path + '.part', self.digests_path)
+
+    def __load_digests(self):
+        if self.digests is None:
+            self.digests = {}
+            if os.path.exists(self.digests_path):
+                with open(self.digests_path, 'r') as fin:
+                    self.digests = json.load(fin)
+        return self.digests
+
+    def __text_path(self, digest):
+        return f'{self.cache_dir}/{digest[:2]}/{digest}.txt'
+
+
+def extract_texts(delegate, paths, cache, workers=None, timeout=EXTRACTION_TIMEOUT):
+    ''' Yield (path, text) for every path as soon as its text is available,
+        text being None when the extraction failed or timed out. Texts
+        already in the cache are not extracted again.
+
+        A single file per worker is submitted at a time, so a file starts
+        being extracted right when it is submitted and only the texts of
+        the running extractions are held. A delegate the alarm of
+        extract_file can not interrupt, stuck in C code, is given up
+        TIMEOUT_GRACE seconds later: the pool is replaced and the other
+        running files are submitted again.
+    '''
+    pending = []
+    for path in paths:
+        digest = cache.known_digest(path)
+        text = cache.get(digest) if digest is not None else None
+        if text is not None:
+            yield (path, text)
+        else:
+            pending.append(path)
+
+    if not pending:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    pending = iter(pending)
+    # future -> (path, time by which the parent gives up on it)
+    running = {}
+    executor = ProcessPoolExecutor(workers)
+
+    def submit(path):
+        future = executor.submit(extract_file, delegate, path, cache.cache_dir, timeout)
+        running[future] = (path, time.monotonic() + timeout + TIMEOUT_GRACE)
+
+    try:
+        while True:
+            for path in islice(pending, workers - len(running)):
+                submit(path)
+            if not running:
+                break
+
+            deadline = min(u[1] for u in running.values())
+            (done, _) = wait(running, max(0, deadline - time.monotonic()), FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                (path, version, digest, text) = future.result()
+                if digest is not None:
+                    cache.remember_digest(path, version, digest)
+                yield (path, text)
+            if done:
+                continue
+
+            now = time.monotonic()
+            expired = [u for (u, v) in running.items() if v[1] <= now]
+            if not expired:
+                continue
+            # the stuck workers can only be stopped with the whole pool,
+            # the files other workers were on are extracted again
+            stop_pool(executor)
+            retried = [v[0] for (u, v) in running.items() if u not in expired]
+            expired = [running[u][0] for u in expired]
+            running.clear()
+            executor = ProcessPoolExecutor(workers)
+            for path in retried:
+                submit(path)
+            for path in expired:
+                print(f'- extraction of {path} killed after {timeout + TIMEOUT_GRACE}s')
+                yield (path, None)
+    finally:
+        if running:
+            stop_pool(executor)
+        else:
+            executor.shutdown()
+        cache.save_digests()
+
+
+def stop_pool(executor):
+    ''' Shut a pool down without waiting for the running tasks, whose
+        workers are killed.
+    '''
+    # Python 3.14 has terminate_workers(), older versions keep the
+    # worker processes in a private attribute
+    if hasattr(executor, 'terminate_workers'):
+        executor.terminate_workers()
+        return
+    for process in list(executor._processes.values()):
+        process.terminate()
+    executor.shutdown(cancel_futures=True)
+
+
+def extract_file(delegate, path, cache_dir, timeout):
+    ''' Hash a file and extract its text unless the cache has it, run in
+        a worker process. Returns (path, version, digest, text).
+    '''
+    try:
+        version = file_version(path)
+        digest = file_digest(path)
+    except OSError as e:
+        print(f'- failed to read {path}: {e}')
+        return (path, None, None, None)
+
+    cache = ExtractionCache(cache_dir)
+    text = cache.get(digest)
+    if text is not None:
+        return (path, version, digest, text)
+
+    def on_timeout(signum, frame):
+        raise ExtractionTimeout()
+
+    previous = signal.signal(signal.SIGALRM, on_timeout)
+    signal.alarm(timeout)
+    try:
+        text = delegate.extract_text(path)
+    except ExtractionTimeout:
+        print(f'- extraction of {path} timed out after {timeout}s')
+        return (path, version, digest, None)
+    except Exception as e:
+        print(f'- extraction of {path} failed: {e}')
+        return (path, version, digest, None)
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+    if text is not None:
+        cache.put(digest, text)
+    return (path, version, digest, text)
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        while True:
+            chunk = fin.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,27 @@
+''' Keeps read-only index files open between queries.
+'''
+import os
+
+_open_files = {}
+
+
+def open_cached(path, loader):
+    ''' Return loader(path), reusing the result of an earlier call for the
+        same path unless the file has been replaced or modified since.
+    '''
+    stat = os.stat(path)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _open_files.get(path, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    value = loader(path)
+    _open_files[path] = (version, value)
+    return value
+
+
+def forget(path):
+    ''' Drop the cached value of a path, to be called once its file is
+        removed so the file is not kept open or mapped.
+    '''
+    _open_files.pop(path, None)
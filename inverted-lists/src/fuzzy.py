@@ -0,0 +1,139 @@
+''' Fuzzy term lookup through a trigram index over the lexicon.
+
+    Every term of the lexicon is padded as $term$ and split into its
+    trigrams. The trigram file maps each trigram to the ordinals of the
+    terms containing it, an ordinal being the position of a term in the
+    sorted lexicon:
+
+        magic
+        header  (trigram count, index offset)
+        lists   of varint ordinal gaps, one list per trigram
+        index   of (varint trigram length, trigram, varint list offset,
+                varint list length) per trigram, in sorted order
+
+    A single edit changes at most 3 trigrams of a term, so terms within
+    edit distance d of a word share at least len(word) - 3 * d of its
+    trigrams. Only the terms sharing the most trigrams with the word are
+    compared with it by edit distance.
+'''
+import os
+import mmap
+import struct
+from collections import Counter
+
+from .postings import vbyte_encode, vbyte_decode
+from .file_cache import open_cached
+
+MAGIC = b'TRI\x01'
+# trigram count, index offset
+HEADER_FORMAT = '=IQ'
+# Max number of candidate terms compared with the word by edit distance.
+MAX_CANDIDATES = 256
+
+
+def term_trigrams(term):
+    padded = f'${term}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def write_trigrams(path, terms):
+    ''' Persist the trigram index of the terms, given in lexicon order.
+    '''
+    lists = {}
+    for (ordinal, term) in enumerate(terms):
+        for trigram in term_trigrams(term):
+            lists.setdefault(trigram, []).append(ordinal)
+
+    index = []
+    with open(path + '.part', 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(bytes(struct.calcsize(HEADER_FORMAT)))
+        for trigram in sorted(lists.keys()):
+            list_raw = bytearray()
+            prev = 0
+            for ordinal in lists[trigram]:
+                vbyte_encode(ordinal - prev, list_raw)
+                prev = ordinal
+            index.append((trigram.encode(), fout.tell(), len(lists[trigram])))
+            fout.write(list_raw)
+
+        index_offset = fout.tell()
+        index_raw = bytearray()
+        for (trigram, pos, length) in index:
+            vbyte_encode(len(trigram), index_raw)
+            index_raw += trigram
+            vbyte_encode(pos, index_raw)
+            vbyte_encode(length, index_raw)
+        fout.write(index_raw)
+
+        fout.seek(len(MAGIC))
+        fout.write(struct.pack(HEADER_FORMAT, len(index), index_offset))
+    os.replace(path + '.part', path)
+
+
+class TrigramIndex:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a trigram file.')
+        (trigram_count, index_offset) = struct.unpack_from(
+            HEADER_FORMAT, self.data, len(MAGIC))
+
+        self.lists = {}
+        pos = index_offset
+        for _ in range(trigram_count):
+            (length, pos) = vbyte_decode(self.data, pos)
+            trigram = self.data[pos:pos + length].decode()
+            pos += length
+            (list_pos, pos) = vbyte_decode(self.data, pos)
+            (list_length, pos) = vbyte_decode(self.data, pos)
+            self.lists[trigram] = (list_pos, list_length)
+
+    def ordinals(self, trigram):
+        (pos, length) = self.lists.get(trigram, (0, 0))
+        ordinal = 0
+        for _ in range(length):
+            (gap, pos) = vbyte_decode(self.data, pos)
+            ordinal += gap
+            yield ordinal
+
+    def candidates(self, word, max_distance):
+        ''' Ordinals of the terms sharing enough trigrams with the word to
+            be within max_distance edits, at most MAX_CANDIDATES of them.
+            Short words share no trigram with some of their neighbours, at
+            least one shared trigram is still required.
+        '''
+        trigrams = term_trigrams(word)
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(self.ordinals(trigram))
+        min_shared = max(len(trigrams) - 3 * max_distance, 1)
+        return [u for (u, n) in shared.most_common(MAX_CANDIDATES) if n >= min_shared]
+
+
+def open_trigrams(path):
+    return open_cached(path, TrigramIndex)
+
+
+def default_distance(word):
+    return 1 if len(word) <= 5 else 2
+
+
+def edit_distance(a, b, max_distance):
+    ''' Levenshtein distance of a and b, or max_distance + 1 as soon as it
+        is known to exceed max_distance.
+    '''
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev = list(range(len(b) + 1))
+    for (i, u) in enumerate(a, 1):
+        curr = [i]
+        for (j, v) in enumerate(b, 1):
+            curr.append(min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (u != v)))
+        if min(curr) > max_distance:
+            return max_distance + 1
+        prev = curr
+    return prev[-1]
@@ -0,0 +1,102 @@
+''' Incremental reading of JSON documents files.
+
+    A file holding a JSON array is parsed one element at a time, any other
+    file is read as JSON Lines, one value per line. Only the element being
+    parsed and a read buffer are held in memory, not the whole file.
+'''
+import json
+from itertools import chain
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_entries(fin, object_hook=None):
+    ''' Yield the elements of the top-level JSON array, or the values of
+        the JSON Lines, read from an opened text file.
+    '''
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    buffer = fin.read(CHUNK_SIZE)
+    pos = skip_whitespace(buffer, 0)
+    while pos == len(buffer):
+        chunk = fin.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buffer = chunk
+        pos = skip_whitespace(buffer, 0)
+
+    if buffer[pos] != '[':
+        yield from iter_json_lines(decoder, buffer[pos:], fin)
+        return
+
+    pos += 1
+    expect_value = True
+    empty = True
+    eof = False
+    # size of the next read, doubled while an element does not fit in the
+    # buffer so it is not decoded again after every CHUNK_SIZE read
+    size = CHUNK_SIZE
+    while True:
+        pos = skip_whitespace(buffer, pos)
+        if pos == len(buffer):
+            if eof:
+                raise ValueError('Unterminated JSON array.')
+            (buffer, pos, eof) = read_more(fin, buffer, pos)
+            continue
+
+        if not expect_value:
+            if buffer[pos] == ']':
+                return
+            if buffer[pos] != ',':
+                raise ValueError(f"Expected ',' or ']' after an array element, got {buffer[pos]!r}.")
+            pos += 1
+            expect_value = True
+            continue
+        if buffer[pos] == ']' and empty:
+            return
+        if buffer[pos] in ',]':
+            raise ValueError(f'Expected an array element, got {buffer[pos]!r}.')
+
+        try:
+            (value, end) = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            (buffer, pos, eof) = read_more(fin, buffer, pos, size)
+            size *= 2
+            continue
+        # a number could go on in the next chunk
+        if end == len(buffer) and not eof:
+            (buffer, pos, eof) = read_more(fin, buffer, pos, size)
+            size *= 2
+            continue
+
+        yield value
+        pos = end
+        expect_value = False
+        empty = False
+        size = CHUNK_SIZE
+
+
+def iter_json_lines(decoder, buffer, fin):
+    lines = buffer.split('\n')
+    # the last line goes on in the rest of the file, which is then read
+    # line by line
+    lines[-1] += fin.readline()
+    for line in chain(lines, fin):
+        if line.strip():
+            yield decoder.decode(line)
+
+
+def read_more(fin, buffer, pos, size=CHUNK_SIZE):
+    ''' Drop the consumed part of the buffer and append the next size
+        characters.
+    '''
+    chunk = fin.read(size)
+    return (buffer[pos:] + chunk, 0, not chunk)
+
+
+def skip_whitespace(buffer, pos):
+    while pos < len(buffer) and buffer[pos] in WHITESPACE:
+        pos += 1
+    return pos
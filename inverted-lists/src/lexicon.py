@@ -0,0 +1,216 @@
+''' Sorted binary lexicon file.
+
+    Terms are stored in lexical order (of their utf-8 bytes) in blocks of
+    BLOCK_SIZE terms. Inside a block every term is front-coded against the
+    previous one and followed by a fixed number of unsigned integer fields:
+
+        varint  shared prefix length
+        varint  suffix length
+        bytes   suffix
+        varint  field values
+
+    The file ends with a sparse index holding the offset and the first term
+    of every block. Only the sparse index is loaded into memory, blocks are
+    read through mmap when a term is looked up.
+'''
+import os
+import mmap
+import struct
+import pickle
+from bisect import bisect_right
+
+from .postings import vbyte_encode, vbyte_decode
+from .file_cache import open_cached
+
+MAGIC = b'LEX\x01'
+# field count, term count, block count, index offset
+HEADER_FORMAT = '=IIIQ'
+BLOCK_SIZE = 32
+
+
+class LexiconWriter:
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self.term_count = 0
+        self.index = []
+        self.block = bytearray()
+        self.prev_term = b''
+
+        # write next to the target and swap in on close, so readers that
+        # still hold the old file mapped are not affected
+        self.file = open(path + '.part', 'wb')
+        self.file.write(MAGIC)
+        self.file.write(bytes(struct.calcsize(HEADER_FORMAT)))
+
+    def add(self, term, values):
+        ''' Append a term, terms have to be added in sorted order.
+        '''
+        term = term.encode()
+        if self.term_count > 0 and term <= self.prev_term:
+            raise ValueError('Lexicon terms must be added in sorted order.')
+        if len(values) != self.fields:
+            raise ValueError(f'Expected {self.fields} values per term.')
+
+        if self.term_count % BLOCK_SIZE == 0:
+            self.__flush_block()
+            self.index.append((self.file.tell(), term))
+            shared = 0
+        else:
+            shared = os.path.commonprefix([self.prev_term, term])
+            shared = len(shared)
+
+        vbyte_encode(shared, self.block)
+        vbyte_encode(len(term) - shared, self.block)
+        self.block += term[shared:]
+        for u in values:
+            vbyte_encode(u, self.block)
+
+        self.prev_term = term
+        self.term_count += 1
+
+    def close(self):
+        self.__flush_block()
+
+        index_offset = self.file.tell()
+        index_raw = bytearray()
+        for (offset, term) in self.index:
+            vbyte_encode(offset, index_raw)
+            vbyte_encode(len(term), index_raw)
+            index_raw += term
+        self.file.write(index_raw)
+
+        self.file.seek(len(MAGIC))
+        self.file.write(struct.pack(HEADER_FORMAT, self.fields,
+                                    self.term_count, len(self.index), index_offset))
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+    def __flush_block(self):
+        self.file.write(self.block)
+        self.block = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path + '.part')
+
+
+class Lexicon:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a lexicon file.')
+        (self.fields, self.term_count, block_count, index_offset) = struct.unpack_from(
+            HEADER_FORMAT, self.data, len(MAGIC))
+
+        self.block_offsets = []
+        self.first_terms = []
+        pos = index_offset
+        for _ in range(block_count):
+            (offset, pos) = vbyte_decode(self.data, pos)
+            (length, pos) = vbyte_decode(self.data, pos)
+            self.block_offsets.append(offset)
+            self.first_terms.append(self.data[pos:pos + length])
+            pos += length
+        self.blocks_end = index_offset
+
+    def get(self, term, default=None):
+        term = term.encode()
+        block_no = bisect_right(self.first_terms, term) - 1
+        if block_no < 0:
+            return default
+        for (u, values) in self.__block_items(block_no):
+            if u == term:
+                return values
+            if u > term:
+                break
+        return default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return self.term_count
+
+    def items(self):
+        for block_no in range(len(self.block_offsets)):
+            for (term, values) in self.__block_items(block_no):
+                yield (term.decode(), values)
+
+    def prefix_items(self, prefix):
+        ''' Terms starting with prefix and their values, in sorted order.
+            Only the blocks that can hold such terms are read.
+        '''
+        prefix = prefix.encode()
+        first_block = max(bisect_right(self.first_terms, prefix) - 1, 0)
+        for block_no in range(first_block, len(self.block_offsets)):
+            for (term, values) in self.__block_items(block_no):
+                if term.startswith(prefix):
+                    yield (term.decode(), values)
+                elif term > prefix:
+                    return
+
+    def term_at(self, ordinal):
+        ''' Term at the given position in sorted order.
+        '''
+        if not 0 <= ordinal < self.term_count:
+            raise IndexError('Lexicon term ordinal out of range.')
+        (block_no, i) = divmod(ordinal, BLOCK_SIZE)
+        for (term, _) in self.__block_items(block_no):
+            if i == 0:
+                return term.decode()
+            i -= 1
+
+    def close(self):
+        self.data.close()
+
+    def __block_items(self, block_no):
+        pos = self.block_offsets[block_no]
+        end = self.block_offsets[block_no + 1] if block_no + 1 < len(
+            self.block_offsets) else self.blocks_end
+        term = b''
+        while pos < end:
+            (shared, pos) = vbyte_decode(self.data, pos)
+            (length, pos) = vbyte_decode(self.data, pos)
+            term = term[:shared] + self.data[pos:pos + length]
+            pos += length
+            values = []
+            for _ in range(self.fields):
+                (u, pos) = vbyte_decode(self.data, pos)
+                values.append(u)
+            yield (term, tuple(values))
+
+
+def write_lexicon(path, lexicon, fields):
+    ''' Persist a dictionary mapping terms to tuples of integers.
+    '''
+    with LexiconWriter(path, fields) as writer:
+        for term in sorted(lexicon.keys()):
+            writer.add(term, lexicon[term])
+
+
+def open_lexicon(path):
+    ''' Return the lexicon stored at path, reusing an already opened one
+        unless the file has been rebuilt since. Lexicons pickled by older
+        versions are loaded as plain dictionaries.
+    '''
+    return open_cached(path, load_lexicon)
+
+
+def load_lexicon(path):
+    with open(path, 'rb') as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            fin.seek(0)
+            return pickle.load(fin)
+    return Lexicon(path)
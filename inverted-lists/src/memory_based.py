@@ -1,3 +1,12 @@
+import heapq
+from array import array
+from bisect import bisect_left
+
+from . import fuzzy
+from .postings import ArrayCursor
+from .query import evaluate, MAX_EXPANSIONS
+from .ranking import top_k
+from .sort_based import extract_doc_terms
 
 
 # Extend existing in-memory index with data obtained from the
@@ -12,3 +21,188 @@ def consume_doc(doc_id, doc_content, index):
         else:
             index[word] = {doc_id: 1}
     return index
+
+
+class MemoryIndex:
+    ''' Index held in memory with the query API of SortBasedIndex.
+
+        Terms are interned to ids and the postings of every term are kept
+        in two growable arrays of unsigned ints, doc ids and frequencies,
+        so a posting costs 8 bytes instead of the dict entries of
+        consume_doc. Documents are expected in ascending id order, other
+        orders are sorted out before the next query.
+    '''
+
+    def __init__(self):
+        self.term_ids = {}
+        self.doc_ids = []
+        self.freqs = []
+        self.stats = MemoryDocStats()
+        self.posting_count = 0
+        self.last_doc_id = -1
+        self.unsorted = False
+        self.sorted_terms = None
+
+    def create_invreted_file(self, docs):
+        ''' Index the documents, replacing anything indexed before.
+        '''
+        self.__init__()
+        self.add_documents(docs)
+        print(f'= Ready with {self.stats.doc_count} docs and {len(self.term_ids)} terms')
+
+    def add_documents(self, docs):
+        for doc in docs:
+            self.add_document(doc.id, doc.content)
+
+    def add_document(self, doc_id, content):
+        stats = extract_doc_terms(content)
+        for (term, freq) in stats.items():
+            term_id = self.term_ids.get(term, None)
+            if term_id is None:
+                term_id = len(self.doc_ids)
+                self.term_ids[term] = term_id
+                self.doc_ids.append(array('I'))
+                self.freqs.append(array('I'))
+                self.sorted_terms = None
+            self.doc_ids[term_id].append(doc_id)
+            self.freqs[term_id].append(freq)
+        self.posting_count += len(stats)
+
+        self.stats.add(doc_id, sum(stats.values()))
+        if doc_id <= self.last_doc_id:
+            self.unsorted = True
+        self.last_doc_id = max(self.last_doc_id, doc_id)
+
+    def retrieve_docs(self, terms):
+        ''' Return ids of the documents matching a boolean query, see
+            query.py for the syntax.
+        '''
+        return list(self.search(terms))
+
+    def rank(self, query, k=20, collection=None):
+        ''' Return the k best documents matching a query as (doc_id, score)
+            pairs ordered by their BM25 score, see ranking.top_k for the
+            collection statistics.
+        '''
+        return top_k(query, self, k, collection)
+
+    def search(self, query):
+        ''' Stream ids of the documents matching a boolean query.
+        '''
+        return evaluate(query, self)
+
+    def term_cursor(self, term, positions=False):
+        ''' Open a cursor over the postings list of a term, None when the
+            term is not indexed. Positions are not kept, phrases are
+            answered as an AND.
+        '''
+        term_id = self.term_ids.get(term, None)
+        if term_id is None:
+            return None
+        self.__sort_postings()
+        return ArrayCursor(self.doc_ids[term_id], self.freqs[term_id])
+
+    def postings(self, term):
+        ''' Return the postings list of a term as (doc_ids, freqs) arrays,
+            both empty when the term is not indexed.
+        '''
+        term_id = self.term_ids.get(term, None)
+        if term_id is None:
+            return (array('I'), array('I'))
+        self.__sort_postings()
+        return (self.doc_ids[term_id], self.freqs[term_id])
+
+    def expand_prefix(self, prefix, limit=MAX_EXPANSIONS):
+        ''' The limit most frequent terms starting with prefix.
+        '''
+        return [u[0] for u in heapq.nlargest(limit, self.__prefix_items(prefix),
+                                             key=lambda u: u[1])]
+
+    def expand_fuzzy(self, word, max_distance=None, limit=MAX_EXPANSIONS):
+        ''' Terms within max_distance edits of the word, closest and then
+            most frequent first. The whole vocabulary is compared with the
+            word, which is fine for the sizes kept in memory.
+        '''
+        if max_distance is None:
+            max_distance = fuzzy.default_distance(word)
+        matches = []
+        for (term, term_id) in self.term_ids.items():
+            distance = fuzzy.edit_distance(word, term, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -len(self.doc_ids[term_id]), term))
+        return [u[2] for u in sorted(matches)[:limit]]
+
+    def suggest(self, prefix, k=10):
+        ''' The k most frequent terms starting with prefix as (term, df)
+            pairs.
+        '''
+        return heapq.nlargest(k, self.__prefix_items(prefix.lower()), key=lambda u: u[1])
+
+    def doc_stats(self):
+        self.__sort_postings()
+        return self.stats
+
+    def document_frequency(self, term):
+        term_id = self.term_ids.get(term, None)
+        return len(self.doc_ids[term_id]) if term_id is not None else 0
+
+    def items(self):
+        ''' Iterate over (term, doc_ids, freqs) in lexical term order.
+        '''
+        self.__sort_postings()
+        for term in sorted(self.term_ids.keys()):
+            term_id = self.term_ids[term]
+            yield (term, self.doc_ids[term_id], self.freqs[term_id])
+
+    def __prefix_items(self, prefix):
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.term_ids.keys())
+        for i in range(bisect_left(self.sorted_terms, prefix), len(self.sorted_terms)):
+            term = self.sorted_terms[i]
+            if not term.startswith(prefix):
+                break
+            yield (term, len(self.doc_ids[self.term_ids[term]]))
+
+    def __sort_postings(self):
+        if not self.unsorted:
+            return
+        for term_id in range(len(self.doc_ids)):
+            postings = sorted(zip(self.doc_ids[term_id], self.freqs[term_id]))
+            self.doc_ids[term_id] = array('I', (u[0] for u in postings))
+            self.freqs[term_id] = array('I', (u[1] for u in postings))
+        self.stats.sort()
+        self.unsorted = False
+
+
+class MemoryDocStats:
+    ''' Doc lengths of a MemoryIndex, with the interface of ranking.DocStats.
+    '''
+
+    def __init__(self):
+        self.doc_ids = array('I')
+        self.lengths = array('I')
+        self.total_length = 0
+
+    @property
+    def doc_count(self):
+        return len(self.doc_ids)
+
+    @property
+    def avg_length(self):
+        return self.total_length / self.doc_count if self.doc_count else 0
+
+    def add(self, doc_id, length):
+        self.doc_ids.append(doc_id)
+        self.lengths.append(length)
+        self.total_length += length
+
+    def length(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < self.doc_count and self.doc_ids[i] == doc_id:
+            return self.lengths[i]
+        return 0
+
+    def sort(self):
+        docs = sorted(zip(self.doc_ids, self.lengths))
+        self.doc_ids = array('I', (u[0] for u in docs))
+        self.lengths = array('I', (u[1] for u in docs))
@@ -0,0 +1,267 @@
+''' Columnar store of the dataset entry fields shown with query results.
+
+        magic
+        header  (row count, schema length)
+        schema  JSON list of {name, type, offset} of every column
+        columns each starting at a multiple of 8 bytes:
+                id      uint64 doc ids in ascending order
+                q / d   int64 / double values, one per row
+                str     uint64 offsets of row count + 1 string bounds
+                        followed by the utf-8 blob of all strings
+
+    Column types are taken from all the values of a field: integers fitting
+    in 64 bits, doubles when some of them are floats, strings as soon as
+    one value is anything else. Missing values are 0 or the empty string.
+    Numeric columns are exposed as memoryviews of the mapped file, so
+    filters can run over a whole column, NumPy can wrap them with
+    numpy.frombuffer without copying.
+
+    Entries are written column by column through temporary files, rows are
+    not kept in memory unless ids come out of order and have to be sorted.
+'''
+import os
+import mmap
+import json
+import struct
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from .file_cache import open_cached
+
+MAGIC = b'COL\x01'
+# row count, schema length
+HEADER_FORMAT = '=QQ'
+ALIGNMENT = 8
+INT64_RANGE = (-(1 << 63), (1 << 63) - 1)
+# Values encoded and written at once.
+WRITE_CHUNK_ROWS = 64 * 1024
+
+
+def write_metadata(path, entries, fields):
+    ''' Persist the given fields of the entries, dictionaries holding an
+        'id', as columns sorted by id.
+    '''
+    ids = ColumnSpool(f'{path}.id.tmp')
+    spools = [ColumnSpool(f'{path}.{u}.tmp') for u in range(len(fields))]
+    try:
+        in_order = True
+        prev_id = None
+        for entry in entries:
+            in_order = in_order and (prev_id is None or entry['id'] >= prev_id)
+            prev_id = entry['id']
+            ids.add(prev_id)
+            for (spool, field) in zip(spools, fields):
+                spool.add(entry.get(field, None))
+        row_count = ids.count
+
+        order = None
+        if not in_order:
+            doc_ids = list(ids.values())
+            order = sorted(range(row_count), key=doc_ids.__getitem__)
+
+        columns = [('id', 'id', ids)] + [(u, v.type, v) for (u, v) in zip(fields, spools)]
+        # the schema holds the column offsets, which depend on its length
+        offset = 0
+        schema = []
+        while True:
+            begin = aligned(len(MAGIC) + struct.calcsize(HEADER_FORMAT) + offset)
+            schema = []
+            for (name, type, spool) in columns:
+                schema.append({'name': name, 'type': type, 'offset': begin})
+                begin = aligned(begin + spool.size(type))
+            schema_raw = json.dumps(schema).encode()
+            if len(schema_raw) == offset:
+                break
+            offset = len(schema_raw)
+
+        with open(path + '.part', 'wb') as fout:
+            fout.write(MAGIC)
+            fout.write(struct.pack(HEADER_FORMAT, row_count, len(schema_raw)))
+            fout.write(schema_raw)
+            for (column, (_, type, spool)) in zip(schema, columns):
+                fout.write(bytes(column['offset'] - fout.tell()))
+                write_column(fout, type, lambda: spool.values(order))
+        os.replace(path + '.part', path)
+    finally:
+        for spool in [ids] + spools:
+            spool.remove()
+
+
+class ColumnSpool:
+    ''' Values of a column kept in a temporary file of JSON lines while the
+        entries are read, along with what is needed to pick its type and
+        size.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.count = 0
+        self.kinds = set()
+        self.blob_length = 0
+
+    def add(self, value):
+        self.file.write(json.dumps(value, default=str))
+        self.file.write('\n')
+        self.count += 1
+        if value is None:
+            return
+        if (isinstance(value, int) and not isinstance(value, bool)
+                and INT64_RANGE[0] <= value <= INT64_RANGE[1]):
+            self.kinds.add('q')
+        elif isinstance(value, float):
+            self.kinds.add('d')
+        else:
+            self.kinds.add('str')
+        self.blob_length += len(str(value).encode())
+
+    @property
+    def type(self):
+        if 'str' in self.kinds or not self.kinds:
+            return 'str'
+        return 'd' if 'd' in self.kinds else 'q'
+
+    def size(self, type):
+        if type == 'str':
+            return (self.count + 1) * ALIGNMENT + self.blob_length
+        return self.count * ALIGNMENT
+
+    def values(self, order=None):
+        ''' Iterate over the values in the order they were added, or in
+            the given order of their row numbers, which reads the whole
+            column into memory.
+        '''
+        self.file.close()
+        with open(self.path, 'r') as fin:
+            values = (json.loads(u) for u in fin)
+            if order is None:
+                yield from values
+            else:
+                values = list(values)
+                yield from (values[u] for u in order)
+
+    def remove(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def write_column(fout, type, values):
+    ''' Encode a column from a function returning an iterator over its
+        values, string columns take two passes, one for the bounds and one
+        for the blob.
+    '''
+    def texts():
+        return (str(u).encode() if u is not None else b'' for u in values())
+
+    if type == 'str':
+        bounds = array('Q', [0])
+        for text in texts():
+            bounds.append(bounds[-1] + len(text))
+            if len(bounds) > WRITE_CHUNK_ROWS:
+                bounds[:-1].tofile(fout)
+                del bounds[:-1]
+        bounds.tofile(fout)
+        for text in texts():
+            fout.write(text)
+        return
+
+    chunk = array('Q' if type == 'id' else type)
+    for value in values():
+        chunk.append(value if value is not None else 0)
+        if len(chunk) == WRITE_CHUNK_ROWS:
+            chunk.tofile(fout)
+            del chunk[:]
+    chunk.tofile(fout)
+
+
+class MetadataStore:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a metadata file.')
+        (self.row_count, schema_length) = struct.unpack_from(HEADER_FORMAT, self.data, len(MAGIC))
+        begin = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+        schema = json.loads(self.data[begin:begin + schema_length])
+
+        view = memoryview(self.data)
+        self.types = {}
+        self.columns = {}
+        self.blobs = {}
+        for column in schema:
+            (name, type, offset) = (column['name'], column['type'], column['offset'])
+            self.types[name] = type
+            if type == 'str':
+                size = (self.row_count + 1) * ALIGNMENT
+                self.columns[name] = view[offset:offset + size].cast('Q')
+                self.blobs[name] = offset + size
+            else:
+                size = self.row_count * ALIGNMENT
+                self.columns[name] = view[offset:offset + size].cast('Q' if type == 'id' else type)
+        self.doc_ids = self.columns['id']
+
+    @property
+    def fields(self):
+        return [u for u in self.types if u != 'id']
+
+    def rows(self, doc_ids, fields=None):
+        ''' Entries of the given docs as dictionaries of the requested
+            fields, None for ids not in the store.
+        '''
+        fields = fields if fields is not None else self.fields
+        rows = []
+        for doc_id in doc_ids:
+            row_no = self.row_no(doc_id)
+            if row_no is None:
+                rows.append(None)
+                continue
+            row = {'id': doc_id}
+            for field in fields:
+                row[field] = self.value(field, row_no)
+            rows.append(row)
+        return rows
+
+    def row_no(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        return i if i < self.row_count and self.doc_ids[i] == doc_id else None
+
+    def value(self, field, row_no):
+        column = self.columns[field]
+        if self.types[field] != 'str':
+            return column[row_no]
+        blob = self.blobs[field]
+        return self.data[blob + column[row_no]:blob + column[row_no + 1]].decode()
+
+    def column(self, field):
+        ''' Values of a numeric field for all rows, in the order of the
+            doc ids column.
+        '''
+        if self.types[field] == 'str':
+            raise ValueError(f'{field} is not a numeric column.')
+        return self.columns[field]
+
+    def select(self, field, low=None, high=None):
+        ''' Ids of the docs whose numeric field lies within [low, high].
+        '''
+        column = self.column(field)
+        values = np.frombuffer(column, dtype=column.format)
+        mask = np.ones(self.row_count, dtype=bool)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        doc_ids = np.frombuffer(self.doc_ids, dtype=np.uint64)
+        return array('Q', doc_ids[mask].tobytes())
+
+
+def open_metadata(path):
+    return open_cached(path, MetadataStore)
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
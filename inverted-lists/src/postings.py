@@ -0,0 +1,559 @@
+''' On-disk layouts of the postings lists stored in the inverted file.
+
+    v1 - no file header; every posting is a fixed ENTRY_FORMAT_INF
+         (doc_id, freq) pair.
+    v2 - file starts with MAGIC_V2. Each postings list is split into blocks
+         of BLOCK_SIZE postings and laid out as:
+
+            varint  block count
+            skip table, one (varint last doc id gap, varint byte length)
+                    pair per block
+            blocks, one (varint doc id gap, varint freq) pair per posting
+
+         Doc id gaps are taken relative to the last doc id of the previous
+         block, so every block can be decoded on its own.
+    v3 - file starts with MAGIC_V3, laid out as v2 with a third varint in
+         every skip table entry: the max impact of the block, an upper
+         bound of the score of any posting in the block.
+    v4 - file starts with MAGIC_V4. Blocks of v3 packed with a fixed width
+         instead of varints, so NumPy decodes a whole list at once:
+
+            byte    width of the doc id gaps, 1, 2 or 4
+            byte    width of the freqs
+            uint32  posting count
+            uint32  last doc id of every block
+            uint32  max impact of every block
+            blocks, each one an array of doc id gaps followed by an array
+                    of freqs
+
+         All integers are little-endian. Every block but the last one
+         holds BLOCK_SIZE postings, so blocks are found without a table
+         of their offsets.
+'''
+import os
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from .file_cache import open_cached
+
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+FORMAT_V3 = 3
+FORMAT_V4 = 4
+# Formats keeping the max impact of every block in the skip table.
+IMPACT_FORMATS = (FORMAT_V3, FORMAT_V4)
+
+MAGIC_V2 = b'INF\x02'
+MAGIC_V3 = b'INF\x03'
+MAGIC_V4 = b'INF\x04'
+ENTRY_FORMAT_INF = '=II'
+# gaps width, freqs width, posting count
+PACKED_HEADER_FORMAT = '<BBI'
+BLOCK_SIZE = 128
+# Doc id reported by a cursor that went past the end of its list.
+END_OF_LIST = 1 << 32
+
+
+def read_format(fin):
+    ''' Detect the format of an opened inverted file and leave the file
+        positioned after the header.
+    '''
+    fin.seek(0)
+    magic = fin.read(len(MAGIC_V2))
+    if magic == MAGIC_V2:
+        return FORMAT_V2
+    if magic == MAGIC_V3:
+        return FORMAT_V3
+    if magic == MAGIC_V4:
+        return FORMAT_V4
+    fin.seek(0)
+    return FORMAT_V1
+
+
+def header(format):
+    return {FORMAT_V2: MAGIC_V2, FORMAT_V3: MAGIC_V3, FORMAT_V4: MAGIC_V4}.get(format, b'')
+
+
+def vbyte_encode(value, out):
+    ''' Append value to the out bytearray, 7 bits per byte with the high
+        bit marking that more bytes follow.
+    '''
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def vbyte_decode(buf, pos):
+    ''' Decode a single value starting at pos; returns (value, next pos).
+    '''
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def encode_postings(postings, format=FORMAT_V2, impacts=None):
+    ''' Encode a list of (doc_id, freq) pairs sorted by doc_id. The v3
+        and v4 formats also need the impacts of the postings, in the same
+        order.
+    '''
+    if format == FORMAT_V1:
+        return b''.join(struct.pack(ENTRY_FORMAT_INF, *u) for u in postings)
+    if format == FORMAT_V4:
+        return encode_packed(postings, impacts)
+
+    skip_table = bytearray()
+    blocks = bytearray()
+    prev_last = 0
+    for i in range(0, len(postings), BLOCK_SIZE):
+        block = bytearray()
+        prev = prev_last
+        for (doc_id, freq) in postings[i:i + BLOCK_SIZE]:
+            vbyte_encode(doc_id - prev, block)
+            vbyte_encode(freq, block)
+            prev = doc_id
+        vbyte_encode(prev - prev_last, skip_table)
+        vbyte_encode(len(block), skip_table)
+        if format in IMPACT_FORMATS:
+            vbyte_encode(int(max(impacts[i:i + BLOCK_SIZE])), skip_table)
+        blocks += block
+        prev_last = prev
+
+    result = bytearray()
+    vbyte_encode((len(postings) + BLOCK_SIZE - 1) // BLOCK_SIZE, result)
+    return result + skip_table + blocks
+
+
+def encode_packed(postings, impacts):
+    ''' Encode a v4 postings list, postings may also be given as an
+        array of (doc_id, freq) rows.
+    '''
+    pairs = np.asarray(postings, dtype=np.int64).reshape(-1, 2)
+    count = len(pairs)
+    doc_ids = pairs[:, 0]
+    gaps = np.diff(doc_ids, prepend=0)
+    freqs = pairs[:, 1]
+    (gaps_dtype, freqs_dtype) = (packed_dtype(gaps), packed_dtype(freqs))
+    block_begins = np.arange(0, count, BLOCK_SIZE)
+    block_lasts = doc_ids[np.minimum(block_begins + BLOCK_SIZE, count) - 1]
+    block_impacts = (np.maximum.reduceat(np.array(impacts, dtype=np.int64), block_begins)
+                     if count else block_begins)
+
+    # full blocks as rows of gaps and freqs, then the last short block
+    full = count // BLOCK_SIZE * BLOCK_SIZE
+    rows = np.hstack([gaps[:full].astype(gaps_dtype).reshape(-1, BLOCK_SIZE).view(np.uint8),
+                      freqs[:full].astype(freqs_dtype).reshape(-1, BLOCK_SIZE).view(np.uint8)])
+    return b''.join([
+        struct.pack(PACKED_HEADER_FORMAT, gaps_dtype.itemsize, freqs_dtype.itemsize, count),
+        block_lasts.astype('<u4').tobytes(),
+        block_impacts.astype('<u4').tobytes(),
+        rows.tobytes(),
+        gaps[full:].astype(gaps_dtype).tobytes(),
+        freqs[full:].astype(freqs_dtype).tobytes()])
+
+
+def packed_dtype(values):
+    ''' Narrowest little-endian unsigned type holding all values.
+    '''
+    top = int(values.max()) if len(values) else 0
+    if top < 1 << 8:
+        return np.dtype('<u1')
+    if top < 1 << 16:
+        return np.dtype('<u2')
+    return np.dtype('<u4')
+
+
+def decode_skip_table(buf, format=FORMAT_V2):
+    ''' Decode the skip table of a v2/v3/v4 postings list.
+        Returns a list of (first doc id base, last doc id, begin, end,
+        max impact) tuples, one per block, where begin/end are offsets into
+        buf. The max impact is None for the v2 format.
+    '''
+    if format == FORMAT_V4:
+        return decode_packed_skip_table(buf)
+
+    (block_count, pos) = vbyte_decode(buf, 0)
+    entries = []
+    for _ in range(block_count):
+        (last_gap, pos) = vbyte_decode(buf, pos)
+        (length, pos) = vbyte_decode(buf, pos)
+        impact = None
+        if format in IMPACT_FORMATS:
+            (impact, pos) = vbyte_decode(buf, pos)
+        entries.append((last_gap, length, impact))
+
+    blocks = []
+    prev_last = 0
+    for (last_gap, length, impact) in entries:
+        blocks.append((prev_last, prev_last + last_gap, pos, pos + length, impact))
+        prev_last += last_gap
+        pos += length
+    return blocks
+
+
+def decode_block(buf, base, begin, end):
+    ''' Decode a single v2 block into a list of (doc_id, freq) pairs.
+        The base is the last doc id of the previous block.
+    '''
+    postings = []
+    doc_id = base
+    pos = begin
+    while pos < end:
+        (gap, pos) = vbyte_decode(buf, pos)
+        (freq, pos) = vbyte_decode(buf, pos)
+        doc_id += gap
+        postings.append((doc_id, freq))
+    return postings
+
+
+def packed_layout(buf):
+    ''' Header of a v4 list as (gaps width, freqs width, posting count,
+        block count, offset of the first block).
+    '''
+    (gaps_width, freqs_width, count) = struct.unpack_from(PACKED_HEADER_FORMAT, buf, 0)
+    block_count = (count + BLOCK_SIZE - 1) // BLOCK_SIZE
+    begin = struct.calcsize(PACKED_HEADER_FORMAT) + 8 * block_count
+    return (gaps_width, freqs_width, count, block_count, begin)
+
+
+def decode_packed_skip_table(buf):
+    (gaps_width, freqs_width, count, block_count, begin) = packed_layout(buf)
+    table = np.frombuffer(buf, '<u4', 2 * block_count, struct.calcsize(PACKED_HEADER_FORMAT))
+    blocks = []
+    prev_last = 0
+    for (block_no, (last, impact)) in enumerate(zip(table[:block_count].tolist(),
+                                                    table[block_count:].tolist())):
+        size = min(BLOCK_SIZE, count - block_no * BLOCK_SIZE) * (gaps_width + freqs_width)
+        blocks.append((prev_last, last, begin, begin + size, impact))
+        prev_last = last
+        begin += size
+    return blocks
+
+
+def decode_packed_block(buf, begin, end):
+    ''' Split a v4 block into its arrays of doc id gaps and freqs, views of
+        buf in their stored widths.
+    '''
+    (gaps_width, freqs_width) = (buf[0], buf[1])
+    count = (end - begin) // (gaps_width + freqs_width)
+    gaps = np.frombuffer(buf, f'<u{gaps_width}', count, begin)
+    freqs = np.frombuffer(buf, f'<u{freqs_width}', count, begin + count * gaps_width)
+    return (gaps, freqs)
+
+
+def decode_postings(buf, format=FORMAT_V2):
+    ''' Decode a whole postings list into (doc_id, freq) pairs.
+    '''
+    if format == FORMAT_V1:
+        return list(struct.iter_unpack(ENTRY_FORMAT_INF, buf))
+    if format == FORMAT_V4:
+        return list(zip(*(u.tolist() for u in decode_arrays(buf, format))))
+
+    postings = []
+    for (base, _, begin, end, _) in decode_skip_table(buf, format):
+        postings.extend(decode_block(buf, base, begin, end))
+    return postings
+
+
+def encode_positions(positions):
+    ''' Encode the ascending positions of a term in a document as varint
+        gaps, prefixed by their size in bytes so the record can be skipped
+        without decoding it.
+    '''
+    gaps = bytearray()
+    prev = 0
+    for u in positions:
+        vbyte_encode(u - prev, gaps)
+        prev = u
+    result = bytearray()
+    vbyte_encode(len(gaps), result)
+    return result + gaps
+
+
+def decode_positions(buf, pos):
+    ''' Decode a positions record starting at pos; returns (positions,
+        next pos).
+    '''
+    (size, pos) = vbyte_decode(buf, pos)
+    end = pos + size
+    positions = []
+    position = 0
+    while pos < end:
+        (gap, pos) = vbyte_decode(buf, pos)
+        position += gap
+        positions.append(position)
+    return (positions, end)
+
+
+def decode_arrays(buf, format=FORMAT_V2):
+    ''' Decode a whole postings list into (doc_ids, freqs) arrays of
+        unsigned ints. v1 lists are not copied, the arrays are strided views
+        of the buffer. v4 lists are decoded by NumPy into memoryviews of
+        uint32 arrays, the doc ids by a running sum of all the gaps as every
+        block starts from the last doc id of the previous one.
+    '''
+    if format == FORMAT_V1:
+        view = memoryview(buf).cast('I')
+        return (view[0::2], view[1::2])
+    if format == FORMAT_V4:
+        (gaps_width, freqs_width, count, _, begin) = packed_layout(buf)
+        width = gaps_width + freqs_width
+        data = np.frombuffer(buf, np.uint8, count * width, begin)
+        # full blocks are rows of gaps and freqs, the last block is shorter
+        full = count // BLOCK_SIZE * BLOCK_SIZE
+        rows = data[:full * width].reshape(-1, BLOCK_SIZE * width)
+        tail = data[full * width:]
+        gaps = np.concatenate([
+            np.ascontiguousarray(rows[:, :BLOCK_SIZE * gaps_width]).view(f'<u{gaps_width}').ravel(),
+            tail[:(count - full) * gaps_width].view(f'<u{gaps_width}')], dtype=np.uint32)
+        freqs = np.concatenate([
+            np.ascontiguousarray(rows[:, BLOCK_SIZE * gaps_width:]).view(f'<u{freqs_width}').ravel(),
+            tail[(count - full) * gaps_width:].view(f'<u{freqs_width}')], dtype=np.uint32)
+        return (memoryview(np.cumsum(gaps, dtype=np.uint32)), memoryview(freqs))
+
+    doc_ids = array('I')
+    freqs = array('I')
+    for (base, _, begin, end, _) in decode_skip_table(buf, format):
+        block = decode_block(buf, base, begin, end)
+        doc_ids.extend(u[0] for u in block)
+        freqs.extend(u[1] for u in block)
+    return (doc_ids, freqs)
+
+
+class PostingsReader:
+    ''' Inverted or positions file mapped into memory. Lists are sliced out
+        of the mapping without copying them.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.format = read_format(fin)
+            if os.fstat(fin.fileno()).st_size == 0:
+                self.data = memoryview(b'')
+            else:
+                self.data = memoryview(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def slice(self, pos, size):
+        return self.data[pos:pos + size]
+
+
+def open_postings(path):
+    return open_cached(path, PostingsReader)
+
+
+def read_positions_record(buf, pos):
+    ''' Raw bytes of the positions record starting at pos.
+    '''
+    (size, begin) = vbyte_decode(buf, pos)
+    return bytes(buf[pos:begin + size])
+
+
+def iter_positions_records(buf):
+    ''' Iterate over raw bytes of consecutive positions records.
+    '''
+    pos = 0
+    while pos < len(buf):
+        record = read_positions_record(buf, pos)
+        pos += len(record)
+        yield record
+
+
+class ArrayCursor:
+    ''' Cursor over postings already decoded into parallel lists of
+        doc ids and frequencies.
+    '''
+
+    def __init__(self, doc_ids, freqs, max_impact=None, block_lasts=None, block_impacts=None):
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.df = len(doc_ids)
+        self.max_impact = max_impact
+        # last doc id and max impact of every BLOCK_SIZE postings, when known
+        self.block_lasts = block_lasts
+        self.block_impacts = block_impacts
+        self.index = 0
+
+    @property
+    def doc(self):
+        return self.doc_ids[self.index] if self.index < self.df else END_OF_LIST
+
+    @property
+    def ordinal(self):
+        return self.index
+
+    @property
+    def freq(self):
+        return self.freqs[self.index]
+
+    def next(self):
+        self.index += 1
+        return self.doc
+
+    def advance(self, target):
+        ''' Move to the first doc id >= target by galloping forward from
+            the current position.
+        '''
+        self.index = gallop(self.doc_ids, target, self.index)
+        return self.doc
+
+    def block_max_impact(self, target):
+        if self.block_impacts is None:
+            return self.max_impact
+        block_no = gallop(self.block_lasts, target, self.index // BLOCK_SIZE)
+        if block_no == len(self.block_lasts):
+            return 0
+        return self.block_impacts[block_no]
+
+
+class BlockCursor:
+    ''' Cursor over a v2/v3/v4 postings list. Only the skip table is decoded
+        upfront, blocks are decoded once the cursor steps into them and
+        blocks ending before an advance target are skipped entirely.
+    '''
+
+    def __init__(self, buf, df, format=FORMAT_V2, max_impact=None):
+        self.buf = buf
+        self.df = df
+        self.max_impact = max_impact
+        self.format = format
+        self.blocks = decode_skip_table(buf, format)
+        self.block_lasts = [u[1] for u in self.blocks]
+        self.block_no = -1
+        self.doc_ids = []
+        self.freqs = []
+        self.index = 0
+        self.__load_block(0)
+
+    @property
+    def doc(self):
+        return self.doc_ids[self.index] if self.index < len(self.doc_ids) else END_OF_LIST
+
+    @property
+    def ordinal(self):
+        return self.block_no * BLOCK_SIZE + self.index
+
+    @property
+    def freq(self):
+        return self.freqs[self.index]
+
+    def next(self):
+        self.index += 1
+        if self.index == len(self.doc_ids):
+            self.__load_block(self.block_no + 1)
+        return self.doc
+
+    def advance(self, target):
+        if self.doc >= target:
+            return self.doc
+        if target > self.block_lasts[self.block_no]:
+            self.__load_block(gallop(self.block_lasts, target, self.block_no))
+        self.index = gallop(self.doc_ids, target, self.index)
+        return self.doc
+
+    def block_max_impact(self, target):
+        ''' Upper bound of the impact of target within this list, taken from
+            the block target would fall into. The cursor does not move.
+        '''
+        block_no = gallop(self.block_lasts, target, self.block_no)
+        if block_no == len(self.blocks):
+            return 0
+        impact = self.blocks[block_no][4]
+        return impact if impact is not None else self.max_impact
+
+    def __load_block(self, block_no):
+        self.block_no = block_no
+        self.index = 0
+        if block_no < len(self.blocks):
+            (base, _, begin, end, _) = self.blocks[block_no]
+            if self.format == FORMAT_V4:
+                (gaps, freqs) = decode_packed_block(self.buf, begin, end)
+                self.doc_ids = (np.cumsum(gaps, dtype=np.int64) + base).tolist()
+                self.freqs = freqs.tolist()
+            else:
+                block = decode_block(self.buf, base, begin, end)
+                self.doc_ids = [u[0] for u in block]
+                self.freqs = [u[1] for u in block]
+        else:
+            self.doc_ids = []
+            self.freqs = []
+
+
+class PositionalCursor:
+    ''' Wraps a postings cursor together with the positions of the term,
+        one record per posting in postings order. Records are only walked
+        forward, skipping the ones of postings the cursor jumped over.
+    '''
+
+    def __init__(self, cursor, buf):
+        self.cursor = cursor
+        self.buf = buf
+        self.df = cursor.df
+        self.max_impact = cursor.max_impact
+        self.record_no = 0
+        self.record_pos = 0
+
+    @property
+    def doc(self):
+        return self.cursor.doc
+
+    @property
+    def freq(self):
+        return self.cursor.freq
+
+    def next(self):
+        return self.cursor.next()
+
+    def advance(self, target):
+        return self.cursor.advance(target)
+
+    def block_max_impact(self, target):
+        return self.cursor.block_max_impact(target)
+
+    def positions(self):
+        ''' Positions of the term in the current document.
+        '''
+        self.__seek_record()
+        return decode_positions(self.buf, self.record_pos)[0]
+
+    def record(self):
+        ''' Raw positions record of the current document.
+        '''
+        self.__seek_record()
+        return read_positions_record(self.buf, self.record_pos)
+
+    def __seek_record(self):
+        while self.record_no < self.cursor.ordinal:
+            (size, pos) = vbyte_decode(self.buf, self.record_pos)
+            self.record_pos = pos + size
+            self.record_no += 1
+
+
+def open_cursor(buf, df, format=FORMAT_V2, max_impact=None):
+    if format == FORMAT_V1:
+        return ArrayCursor(*decode_arrays(buf, format), max_impact)
+    return BlockCursor(buf, df, format, max_impact)
+
+
+def gallop(values, target, lo):
+    ''' Index of the first item of sorted values >= target, looking no
+        further back than lo. Probes 1, 2, 4, ... items ahead first so the
+        cost depends on the distance travelled, not the list length.
+    '''
+    n = len(values)
+    if lo >= n or values[lo] >= target:
+        return lo
+    step = 1
+    while lo + step < n and values[lo + step] < target:
+        lo += step
+        step *= 2
+    return bisect_left(values, target, lo + 1, min(lo + step + 1, n))
@@ -0,0 +1,447 @@
+''' Boolean queries over postings lists.
+
+    Grammar of the query strings, operators are upper-case words:
+
+        expr    := and_expr ('OR' and_expr)*
+        and_expr:= unary (['AND'] unary)*
+        unary   := ('NOT' | '-') unary | '(' expr ')' | phrase | prefix
+                 | fuzzy | term
+        phrase  := '"' term+ '"' ['~' slop]
+        prefix  := term '*'
+        fuzzy   := term '~' [distance]
+
+    Adjacent terms are implicitly AND-ed, so swift programming matches
+    documents containing both words, while "swift programming" only matches
+    documents where they follow each other. A slop allows up to that many
+    other words between consecutive phrase terms. Phrases need an index
+    built with positions, otherwise they are answered as an AND. A prefix
+    such as kube* matches any of the MAX_EXPANSIONS most frequent terms
+    starting with kube. A fuzzy term such as pyton~ matches the terms
+    within a few edits of it, pyton~1 within a single edit. Parentheses
+    and NOTs nested deeper than MAX_QUERY_DEPTH are ignored, their operands
+    are parsed as if they were written without them.
+
+    Queries are evaluated through cursors. An index only has to provide
+    term_cursor(term, positions=False), returning an object with the doc,
+    freq and df attributes and the next() and advance(target) methods of the
+    cursors in postings.py, or None for unknown terms. Cursors opened with
+    positions should also provide positions() of the current document.
+    Prefixes are expanded through expand_prefix(prefix, limit) and fuzzy
+    terms through expand_fuzzy(term, max_distance, limit), both returning
+    the terms to OR together. Conjunctions of terms are intersected over
+    whole NumPy arrays instead, when the index also provides postings(term)
+    returning the (doc_ids, freqs) arrays of a term.
+'''
+import re
+from bisect import bisect_right
+
+import numpy as np
+
+from .postings import END_OF_LIST
+
+TOKEN_PATTERN = re.compile(r'"[^"]*"?(?:~\d+)?|\(|\)|[^\s()"]+')
+FUZZY_PATTERN = re.compile(r'(.+)~(\d*)$')
+PHRASE_PATTERN = re.compile(r'^"([^"]*)"?(?:~(\d+))?$')
+OPERATORS = ('AND', 'OR', 'NOT')
+MAX_EXPANSIONS = 64
+# Nesting of parentheses and NOTs parsed, deeper ones are ignored.
+MAX_QUERY_DEPTH = 32
+
+
+class Term:
+
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return f'Term({self.term!r})'
+
+
+class And:
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f'And({self.children!r})'
+
+
+class Or:
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f'Or({self.children!r})'
+
+
+class Phrase:
+
+    def __init__(self, terms, slop=0):
+        self.terms = terms
+        self.slop = slop
+
+    def __repr__(self):
+        return f'Phrase({self.terms!r}, {self.slop})'
+
+
+class Prefix:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def __repr__(self):
+        return f'Prefix({self.prefix!r})'
+
+
+class Fuzzy:
+
+    def __init__(self, term, max_distance=None):
+        self.term = term
+        self.max_distance = max_distance
+
+    def __repr__(self):
+        return f'Fuzzy({self.term!r}, {self.max_distance})'
+
+
+class Not:
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return f'Not({self.child!r})'
+
+
+def parse_query(text):
+    ''' Parse a query string into a tree of Term/Phrase/Prefix/Fuzzy/And/
+        Or/Not nodes.
+        Returns None for an empty query.
+    '''
+    tokens = TOKEN_PATTERN.findall(text)
+    pos = 0
+    depth = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def expr():
+        children = [and_expr()]
+        while peek() == 'OR':
+            take()
+            children.append(and_expr())
+        children = [u for u in children if u is not None]
+        if len(children) < 2:
+            return children[0] if children else None
+        return Or(children)
+
+    def and_expr():
+        children = []
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                take()
+                continue
+            children.append(unary())
+        children = [u for u in children if u is not None]
+        if len(children) < 2:
+            return children[0] if children else None
+        return And(children)
+
+    def unary():
+        nonlocal depth
+        token = take()
+        if token in ('NOT', '(') and depth >= MAX_QUERY_DEPTH:
+            return None
+        if token == 'NOT':
+            depth += 1
+            child = unary() if peek() not in (None, 'OR', ')') else None
+            depth -= 1
+            return Not(child) if child is not None else None
+        if token.startswith('-') and len(token) > 1:
+            return Not(term(token[1:]))
+        if token == '(':
+            depth += 1
+            node = expr()
+            depth -= 1
+            if peek() == ')':
+                take()
+            return node
+        if token.startswith('"'):
+            return phrase(token)
+        return term(token)
+
+    def term(token):
+        if token.endswith('*') and len(token) > 1:
+            return Prefix(token[:-1].lower())
+        fuzzy = FUZZY_PATTERN.match(token)
+        if fuzzy is not None:
+            (text, distance) = fuzzy.groups()
+            return Fuzzy(text.lower(), int(distance) if distance else None)
+        return Term(token.lower())
+
+    def phrase(token):
+        # a slop follows the closing quote, a ~ inside is part of the text
+        (text, slop) = PHRASE_PATTERN.match(token).groups()
+        terms = text.lower().split()
+        if len(terms) < 2:
+            return Term(terms[0]) if terms else None
+        return Phrase(terms, int(slop) if slop else 0)
+
+    node = expr()
+    # unbalanced closing parentheses end the expression early, parse the
+    # rest as if it was AND-ed to it
+    while pos < len(tokens):
+        take()
+        rest = expr()
+        if rest is not None:
+            node = And([node, rest]) if node is not None else rest
+    return node
+
+
+class EmptyCursor:
+    df = 0
+    doc = END_OF_LIST
+
+    def next(self):
+        return END_OF_LIST
+
+    def advance(self, target):
+        return END_OF_LIST
+
+
+class AndCursor:
+    ''' Intersection of cursors. The shortest list leads and the others
+        are advanced to its candidates, so the cost is driven by the
+        shortest list. Documents present in any of the excluded cursors
+        are skipped.
+    '''
+
+    def __init__(self, cursors, excluded=()):
+        self.cursors = sorted(cursors, key=lambda u: u.df)
+        self.excluded = excluded
+        self.df = self.cursors[0].df
+        self.doc = self.__align(self.cursors[0].doc)
+
+    def next(self):
+        self.doc = self.__align(self.cursors[0].next())
+        return self.doc
+
+    def advance(self, target):
+        if self.doc < target:
+            self.doc = self.__align(self.cursors[0].advance(target))
+        return self.doc
+
+    def __align(self, candidate):
+        (lead, others) = (self.cursors[0], self.cursors[1:])
+        while candidate != END_OF_LIST:
+            for cursor in others:
+                doc = cursor.advance(candidate)
+                if doc != candidate:
+                    candidate = lead.advance(doc)
+                    break
+            else:
+                if any(u.advance(candidate) == candidate for u in self.excluded):
+                    candidate = lead.next()
+                    continue
+                return candidate
+        return END_OF_LIST
+
+
+class PhraseCursor:
+    ''' Documents containing all the phrase terms are found by intersecting
+        their postings first, only those are checked for term positions.
+    '''
+
+    def __init__(self, cursors, slop):
+        self.cursors = cursors
+        self.slop = slop
+        self.matches = AndCursor(cursors)
+        self.df = self.matches.df
+        self.doc = self.__verify(self.matches.doc)
+
+    def next(self):
+        self.doc = self.__verify(self.matches.next())
+        return self.doc
+
+    def advance(self, target):
+        if self.doc < target:
+            self.doc = self.__verify(self.matches.advance(target))
+        return self.doc
+
+    def __verify(self, doc):
+        while doc != END_OF_LIST:
+            if phrase_matches([u.positions() for u in self.cursors], self.slop):
+                return doc
+            doc = self.matches.next()
+        return END_OF_LIST
+
+
+def phrase_matches(term_positions, slop):
+    ''' Whether every list contains a position following one of the previous
+        list by at most slop + 1 words.
+    '''
+    for start in term_positions[0]:
+        prev = start
+        for positions in term_positions[1:]:
+            i = bisect_right(positions, prev)
+            if i == len(positions) or positions[i] > prev + 1 + slop:
+                break
+            prev = positions[i]
+        else:
+            return True
+    return False
+
+
+class OrCursor:
+    ''' Union of cursors.
+    '''
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+        self.df = sum(u.df for u in cursors)
+        self.doc = min(u.doc for u in cursors)
+
+    def next(self):
+        return self.advance(self.doc + 1)
+
+    def advance(self, target):
+        if self.doc < target:
+            self.doc = min(u.advance(target) for u in self.cursors)
+        return self.doc
+
+
+def conjunction_terms(node):
+    ''' The (included, excluded) terms of a query tree made of an AND of
+        terms and NOTs of terms, None for any other tree.
+    '''
+    if not isinstance(node, And):
+        return None
+    included = [u.term for u in node.children if isinstance(u, Term)]
+    excluded = [u.child.term for u in node.children
+                if isinstance(u, Not) and isinstance(u.child, Term)]
+    if not included or len(included) + len(excluded) != len(node.children):
+        return None
+    return (included, excluded)
+
+
+def match_conjunction(index, included, excluded):
+    ''' Intersect the postings lists of the included terms and remove the
+        documents of the excluded ones. Returns the matching doc ids as a
+        NumPy array and, for every included term, its (doc_ids, freqs)
+        arrays and the positions of the matches in them.
+    '''
+    lists = [tuple(np.asarray(u) for u in index.postings(term)) for term in included]
+    matches = min((u[0] for u in lists), key=len)
+    for (doc_ids, _) in lists:
+        matches = matches[contains(doc_ids, matches)]
+    for term in excluded:
+        matches = matches[~contains(np.asarray(index.postings(term)[0]), matches)]
+    positions = [np.searchsorted(u[0], matches) for u in lists]
+    return (matches, lists, positions)
+
+
+def contains(doc_ids, targets):
+    ''' Mask of the targets found in the sorted doc ids.
+    '''
+    if len(doc_ids) == 0:
+        return np.zeros(len(targets), dtype=bool)
+    positions = np.minimum(np.searchsorted(doc_ids, targets), len(doc_ids) - 1)
+    return doc_ids[positions] == targets
+
+
+def open_query_cursor(node, index):
+    ''' Build a cursor evaluating the query tree over the given index.
+        A NOT can only exclude documents matched by its AND siblings, on
+        its own it matches nothing.
+    '''
+    if isinstance(node, Term):
+        cursor = index.term_cursor(node.term)
+        return cursor if cursor is not None else EmptyCursor()
+
+    if isinstance(node, Phrase):
+        cursors = [index.term_cursor(u, positions=True) for u in node.terms]
+        if any(u is None for u in cursors):
+            return EmptyCursor()
+        if all(hasattr(u, 'positions') for u in cursors):
+            return PhraseCursor(cursors, node.slop)
+        return AndCursor(cursors)
+
+    if isinstance(node, Or):
+        cursors = [open_query_cursor(u, index) for u in node.children]
+        cursors = [u for u in cursors if u.df > 0]
+        if not cursors:
+            return EmptyCursor()
+        return OrCursor(cursors) if len(cursors) > 1 else cursors[0]
+
+    if isinstance(node, And):
+        included = [u for u in node.children if not isinstance(u, Not)]
+        excluded = [u.child for u in node.children if isinstance(u, Not)]
+        if not included:
+            return EmptyCursor()
+        cursors = [open_query_cursor(u, index) for u in included]
+        if any(u.df == 0 for u in cursors):
+            return EmptyCursor()
+        excluded = [open_query_cursor(u, index) for u in excluded]
+        excluded = [u for u in excluded if u.df > 0]
+        if len(cursors) == 1 and not excluded:
+            return cursors[0]
+        return AndCursor(cursors, excluded)
+
+    return EmptyCursor()
+
+
+def make_fuzzy(query):
+    ''' Rewrite a query string so that all its plain terms are fuzzy.
+    '''
+    def rewrite(token):
+        if (token in OPERATORS or token in ('(', ')', '-') or token[0] == '"'
+                or token[-1] in '*~' or FUZZY_PATTERN.match(token)):
+            return token
+        return token + '~'
+    return ' '.join(rewrite(u) for u in TOKEN_PATTERN.findall(query))
+
+
+def expand_query(node, index):
+    ''' Replace the prefixes and fuzzy terms of a query tree with an OR of
+        the terms they expand to. ORs nested in an OR are flattened.
+    '''
+    if isinstance(node, (Prefix, Fuzzy)):
+        if isinstance(node, Prefix):
+            terms = index.expand_prefix(node.prefix, MAX_EXPANSIONS)
+        else:
+            terms = index.expand_fuzzy(node.term, node.max_distance, MAX_EXPANSIONS)
+        return Term(terms[0]) if len(terms) == 1 else Or([Term(u) for u in terms])
+    if isinstance(node, Not):
+        return Not(expand_query(node.child, index))
+    if isinstance(node, And):
+        return And([expand_query(u, index) for u in node.children])
+    if isinstance(node, Or):
+        children = []
+        for u in node.children:
+            u = expand_query(u, index)
+            children.extend(u.children if isinstance(u, Or) else [u])
+        return Or(children)
+    return node
+
+
+def evaluate(query, index):
+    ''' Stream the ids of documents matching a query string.
+    '''
+    node = parse_query(query)
+    if node is None:
+        return
+    node = expand_query(node, index)
+    conjunction = conjunction_terms(node)
+    if conjunction is not None and hasattr(index, 'postings'):
+        yield from match_conjunction(index, *conjunction)[0].tolist()
+        return
+    cursor = open_query_cursor(node, index)
+    doc = cursor.doc
+    while doc != END_OF_LIST:
+        yield doc
+        doc = cursor.next()
@@ -0,0 +1,307 @@
+''' BM25 ranking of query results.
+
+    Scoring needs the length of every document and the collection totals,
+    those are written next to the inverted file as a doc stats file:
+
+        header  (doc count, total length of all docs)
+        array   of doc ids in ascending order
+        array   of doc lengths, in the same order
+
+    An index holding only a part of a collection scores with the totals
+    and document frequencies of the whole collection when given them as
+    CollectionStats, so scores of all parts are comparable.
+'''
+import os
+import math
+import mmap
+import heapq
+import struct
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from .postings import END_OF_LIST
+from .query import (Term, Phrase, And, Or, parse_query, expand_query, open_query_cursor,
+                    conjunction_terms, match_conjunction)
+from .file_cache import open_cached
+
+HEADER_FORMAT = '=QQ'
+K1 = 1.2
+B = 0.75
+# Impacts are scores stored as integers in the postings, rounded up so
+# they remain upper bounds: impact = ceil(score * IMPACT_SCALE).
+IMPACT_SCALE = 1000
+
+
+def write_doc_stats(path, doc_lengths):
+    ''' Persist a dictionary mapping doc ids to their lengths in terms.
+    '''
+    doc_ids = array('I', sorted(doc_lengths.keys()))
+    lengths = array('I', (doc_lengths[u] for u in doc_ids))
+    with open(path + '.part', 'wb') as fout:
+        fout.write(struct.pack(HEADER_FORMAT, len(doc_ids), sum(lengths)))
+        fout.write(doc_ids.tobytes())
+        fout.write(lengths.tobytes())
+    os.replace(path + '.part', path)
+
+
+class DocStats:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.doc_count, self.total_length) = struct.unpack_from(HEADER_FORMAT, self.data)
+
+        begin = struct.calcsize(HEADER_FORMAT)
+        size = self.doc_count * array('I').itemsize
+        view = memoryview(self.data)
+        self.doc_ids = view[begin:begin + size].cast('I')
+        self.lengths = view[begin + size:begin + 2 * size].cast('I')
+
+    @property
+    def avg_length(self):
+        return self.total_length / self.doc_count if self.doc_count else 0
+
+    def length(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < self.doc_count and self.doc_ids[i] == doc_id:
+            return self.lengths[i]
+        return 0
+
+
+def open_doc_stats(path):
+    return open_cached(path, DocStats)
+
+
+class CollectionStats:
+    ''' Doc count, total length and document frequencies of the query terms
+        summed over the indexes a collection is split into.
+    '''
+
+    def __init__(self, doc_count, total_length, dfs):
+        self.doc_count = doc_count
+        self.total_length = total_length
+        self.dfs = dfs
+
+    @property
+    def avg_length(self):
+        return self.total_length / self.doc_count if self.doc_count else 0
+
+
+def collection_stats(query, indexes):
+    ''' Collect the CollectionStats of a query over indexes providing
+        doc_stats() and document_frequency(term). Indexes hiding deleted
+        documents also provide live_totals(), their doc count and total
+        length without them. Prefixes and fuzzy terms are expanded by every
+        index, the dfs cover all their expansions.
+    '''
+    node = parse_query(query)
+    (doc_count, total_length, dfs) = (0, 0, {})
+    for index in indexes:
+        if hasattr(index, 'live_totals'):
+            totals = index.live_totals()
+        else:
+            stats = index.doc_stats()
+            totals = (stats.doc_count, stats.total_length)
+        doc_count += totals[0]
+        total_length += totals[1]
+        if node is None:
+            continue
+        for term in set(scored_terms(expand_query(node, index))):
+            dfs[term] = dfs.get(term, 0) + index.document_frequency(term)
+    return CollectionStats(doc_count, total_length, dfs)
+
+
+def idf(df, doc_count):
+    return math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+
+
+def bm25(freq, doc_length, term_idf, avg_length):
+    norm = K1 * (1 - B + B * doc_length / avg_length) if avg_length else K1
+    return term_idf * freq * (K1 + 1) / (freq + norm)
+
+
+def posting_impacts(freqs, doc_lengths, doc_count, avg_length):
+    ''' Quantized BM25 scores of the postings of a term, given as NumPy
+        arrays of their freqs and of the lengths of their documents.
+    '''
+    return np.ceil(bm25_array(freqs, doc_lengths, idf(len(freqs), doc_count), avg_length)
+                   * IMPACT_SCALE).astype(np.int64)
+
+
+def bm25_array(freqs, doc_lengths, term_idf, avg_length):
+    ''' bm25 over whole arrays, same operations in the same order so the
+        scores are equal to the ones of bm25.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    if avg_length:
+        norm = K1 * (1 - B + B * np.asarray(doc_lengths, dtype=np.float64) / avg_length)
+    else:
+        norm = K1
+    return term_idf * freqs * (K1 + 1) / (freqs + norm)
+
+
+def scored_terms(node):
+    ''' Terms of a query tree that contribute to the score, i.e. all of
+        them except the excluded ones.
+    '''
+    if isinstance(node, Term):
+        return [node.term]
+    if isinstance(node, Phrase):
+        return node.terms
+    if isinstance(node, (And, Or)):
+        return [t for u in node.children for t in scored_terms(u)]
+    return []
+
+
+def top_k(query, index, k, collection=None):
+    ''' Rank documents matching the query with BM25 and return the best k
+        as (doc_id, score) pairs, best first. Only a heap of k documents is
+        kept while the matches are streamed. Conjunctions of terms are
+        scored over whole arrays instead, see query.py. Scores use the
+        statistics of the collection when given, those of the index
+        otherwise.
+
+        The index has to provide term_cursor(term), expand_prefix(prefix,
+        limit) and doc_stats().
+    '''
+    node = parse_query(query)
+    if node is None or k <= 0:
+        return []
+    node = expand_query(node, index)
+
+    stats = index.doc_stats()
+    totals = collection if collection is not None else stats
+    avg_length = totals.avg_length
+
+    def term_idf(term, df):
+        if collection is None:
+            return idf(df, stats.doc_count)
+        return idf(collection.dfs.get(term, df), collection.doc_count)
+
+    terms = list(set(scored_terms(node)))
+    conjunction = conjunction_terms(node)
+    if conjunction is not None and hasattr(index, 'postings'):
+        return conjunction_top_k(index, conjunction, terms, term_idf, stats, k, avg_length)
+
+    scorers = []
+    for term in terms:
+        cursor = index.term_cursor(term)
+        if cursor is None:
+            continue
+        if collection is None:
+            scorers.append((cursor, term_idf(term, cursor.df), 1))
+            continue
+        # impacts were computed with the statistics of the index, scale
+        # them so they stay upper bounds of the collection scores
+        bound_scale = (term_idf(term, cursor.df) / idf(cursor.df, stats.doc_count)
+                       * max(1, avg_length / stats.avg_length))
+        scorers.append((cursor, term_idf(term, cursor.df), bound_scale))
+
+    is_disjunction = isinstance(node, Term) or (
+        isinstance(node, Or) and all(isinstance(u, Term) for u in node.children))
+    if is_disjunction and all(u[0].max_impact is not None for u in scorers):
+        return max_score_top_k(scorers, stats, k, avg_length)
+
+    matches = open_query_cursor(node, index)
+    heap = []
+    doc = matches.doc
+    while doc != END_OF_LIST:
+        doc_length = stats.length(doc)
+        score = 0
+        for (cursor, term_idf, _) in scorers:
+            if cursor.advance(doc) == doc:
+                score += bm25(cursor.freq, doc_length, term_idf, avg_length)
+
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -doc))
+        doc = matches.next()
+
+    return [(-doc, score) for (score, doc) in sorted(heap, reverse=True)]
+
+
+def conjunction_top_k(index, conjunction, terms, term_idf, stats, k, avg_length):
+    ''' Score all the matches of a conjunction of terms at once: freqs and
+        doc lengths of the matches are gathered into arrays and the BM25
+        scores of the terms added up in the order of terms, as top_k does
+        one document at a time.
+    '''
+    (included, excluded) = conjunction
+    (matches, lists, positions) = match_conjunction(index, included, excluded)
+    if len(matches) == 0:
+        return []
+
+    doc_ids = np.asarray(stats.doc_ids)
+    lengths = np.asarray(stats.lengths)[np.searchsorted(doc_ids, matches)]
+    postings = {t: (u, v) for (t, u, v) in zip(included, lists, positions)}
+    scores = np.zeros(len(matches))
+    for term in terms:
+        ((term_doc_ids, term_freqs), term_positions) = postings[term]
+        scores += bm25_array(term_freqs[term_positions], lengths,
+                             term_idf(term, len(term_doc_ids)), avg_length)
+
+    # best scores first, lower doc ids first among equal scores
+    best = np.lexsort((matches, -scores))[:k]
+    return list(zip(matches[best].tolist(), scores[best].tolist()))
+
+
+def max_score_top_k(scorers, stats, k, avg_length):
+    ''' MaxScore evaluation of a disjunction of terms given as
+        (cursor, idf, bound scale) triples, the impacts of a cursor times
+        its bound scale being upper bounds of the term scores.
+
+        Terms are ordered by their max impact. Once the heap is full, the
+        terms whose bounds add up to no more than the k-th best score can not
+        make a document enter the heap on their own: they become
+        non-essential and are only advanced to candidates produced by the
+        remaining essential terms. Candidates are dropped as soon as their
+        score plus the block max impacts of the unchecked terms can not beat
+        the heap.
+    '''
+    scorers = sorted(scorers, key=lambda u: u[0].max_impact * u[2])
+    # bounds[i] - sum of the max impacts of the terms before i
+    bounds = [0]
+    for (cursor, _, bound_scale) in scorers:
+        bounds.append(bounds[-1] + cursor.max_impact * bound_scale / IMPACT_SCALE)
+
+    heap = []
+    threshold = None
+    first_essential = 0
+    while first_essential < len(scorers):
+        essential = scorers[first_essential:]
+        doc = min(u[0].doc for u in essential)
+        if doc == END_OF_LIST:
+            break
+
+        doc_length = stats.length(doc)
+        score = 0
+        for (cursor, term_idf, _) in essential:
+            if cursor.doc == doc:
+                score += bm25(cursor.freq, doc_length, term_idf, avg_length)
+                cursor.next()
+
+        for i in range(first_essential - 1, -1, -1):
+            (cursor, term_idf, bound_scale) = scorers[i]
+            bound = bounds[i] + cursor.block_max_impact(doc) * bound_scale / IMPACT_SCALE
+            if threshold is not None and score + bound <= threshold:
+                score = None
+                break
+            if cursor.advance(doc) == doc:
+                score += bm25(cursor.freq, doc_length, term_idf, avg_length)
+
+        if score is None:
+            continue
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -doc))
+
+        if len(heap) == k:
+            threshold = heap[0][0]
+            while first_essential < len(scorers) and bounds[first_essential + 1] <= threshold:
+                first_essential += 1
+
+    return [(-doc, score) for (score, doc) in sorted(heap, reverse=True)]
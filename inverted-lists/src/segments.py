@@ -0,0 +1,339 @@
+''' Incremental indexing with immutable segments.
+
+    New documents are indexed into a new small segment, which is a complete
+    SortBasedIndex of its own, instead of rebuilding the whole index.
+    Deletes are recorded as tombstones and queries fan out over all live
+    segments. Segments of a similar size are merged in the background
+    following a tiered policy: once MERGE_FACTOR segments share a tier
+    (log base MERGE_FACTOR of their doc count) they are merged into one.
+
+    Every segment has a sequence number. A tombstone hides the doc id in
+    segments with a lower sequence number only, so re-adding a document
+    deletes its older versions without hiding the new one. A merged segment
+    takes the highest sequence number of its sources.
+
+    The segments and tombstones are listed in a JSON manifest.
+'''
+import os
+import json
+import heapq
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from . import file_cache
+from .sort_based import SortBasedIndex
+from .query import evaluate
+from .ranking import top_k, collection_stats
+
+MERGE_FACTOR = 10
+SEGMENT_FILE_EXTENSIONS = ('.lex', '.inf', '.dls', '.pos', '.tri', '.sug')
+
+
+class SegmentedIndex:
+
+    def __init__(self, base_dir, name, merge_factor=MERGE_FACTOR,
+                 background=True, positional=False):
+        self.base_dir = base_dir
+        self.name = name
+        self.merge_factor = merge_factor
+        self.background = background
+        self.positional = positional
+
+        self.lock = threading.RLock()
+        self.merge_thread = None
+        self.merging = set()
+        self.active_queries = 0
+        self.obsolete = []
+
+        self.__load_manifest()
+
+    # ----------------- Public API
+
+    def add_documents(self, docs):
+        ''' Index the documents into a new segment. Older versions of the
+            same doc ids are deleted.
+        '''
+        with self.lock:
+            segment_id = self.__next_id()
+
+        doc_ids = []
+
+        def docs_gen():
+            for doc in docs:
+                doc_ids.append(doc.id)
+                yield doc
+
+        index = self.__segment_index(segment_id)
+        index.create_invreted_file(docs_gen())
+        if not doc_ids:
+            self.__remove_segment_files(segment_id)
+            return
+
+        with self.lock:
+            seq = self.__next_seq()
+            for doc_id in doc_ids:
+                self.tombstones[doc_id] = seq
+            self.segments.append({'id': segment_id, 'seq': seq, 'docs': len(doc_ids)})
+            self.__save_manifest()
+
+        self.__maybe_merge()
+
+    def delete_documents(self, doc_ids):
+        with self.lock:
+            seq = self.__next_seq()
+            for doc_id in doc_ids:
+                self.tombstones[doc_id] = seq
+            self.__save_manifest()
+
+    def retrieve_docs(self, terms):
+        with self.__snapshot() as views:
+            return list(heapq.merge(*[evaluate(terms, u) for u in views]))
+
+    def rank(self, query, k=20):
+        ''' Merge the best k documents of every segment. Scores use the
+            statistics of all the live documents, so a document scores the
+            same whatever segment it lives in.
+        '''
+        with self.__snapshot() as views:
+            collection = collection_stats(query, views)
+            results = [u for view in views for u in top_k(query, view, k, collection)]
+        return sorted(results, key=lambda u: (-u[1], u[0]))[:k]
+
+    def wait_for_merges(self):
+        thread = self.merge_thread
+        if thread is not None:
+            thread.join()
+
+    @property
+    def segment_count(self):
+        return len(self.segments)
+
+    # ----------------- Merging
+
+    def __maybe_merge(self):
+        if not self.background:
+            while self.__merge_next():
+                pass
+            return
+
+        with self.lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return
+            self.merge_thread = threading.Thread(target=self.__merge_loop, daemon=True)
+            self.merge_thread.start()
+
+    def __merge_loop(self):
+        while self.__merge_next():
+            pass
+
+    def __merge_next(self):
+        ''' Merge the oldest segments of the first full tier, if any.
+            Returns whether a merge took place.
+        '''
+        with self.lock:
+            tiers = {}
+            for u in self.segments:
+                if u['id'] not in self.merging:
+                    tier = self.__tier(u['docs'])
+                    tiers.setdefault(tier, []).append(u)
+            candidates = [u for u in tiers.values() if len(u) >= self.merge_factor]
+            if not candidates:
+                return False
+
+            segments = sorted(candidates[0], key=lambda u: u['seq'])[:self.merge_factor]
+            self.merging.update(u['id'] for u in segments)
+            segment_id = self.__next_id()
+            sources = [(self.__segment_index(u['id']), self.__deleted(u)) for u in segments]
+
+        index = self.__segment_index(segment_id)
+        index.merge_indexes(sources)
+
+        with self.lock:
+            merged_ids = {u['id'] for u in segments}
+            self.segments = [u for u in self.segments if u['id'] not in merged_ids]
+            doc_count = index.doc_stats().doc_count
+            if doc_count > 0:
+                self.segments.append({
+                    'id': segment_id,
+                    'seq': max(u['seq'] for u in segments),
+                    'docs': doc_count})
+            else:
+                self.obsolete.append(segment_id)
+            self.merging.difference_update(merged_ids)
+            self.obsolete.extend(merged_ids)
+            self.__drop_tombstones()
+            self.__save_manifest()
+            self.__remove_obsolete()
+        return True
+
+    # ----------------- Private methods
+
+    @contextmanager
+    def __snapshot(self):
+        ''' Views of the live segments; files of segments merged meanwhile
+            are kept until the last query using them is done.
+        '''
+        with self.lock:
+            views = [SegmentView(self.__segment_index(u['id']), self.__deleted(u))
+                     for u in self.segments]
+            self.active_queries += 1
+        try:
+            yield views
+        finally:
+            with self.lock:
+                self.active_queries -= 1
+                self.__remove_obsolete()
+
+    def __tier(self, doc_count):
+        ''' Floor of log base merge_factor of the doc count, in integers so
+            exact powers land in their own tier.
+        '''
+        tier = 0
+        while doc_count >= self.merge_factor:
+            doc_count //= self.merge_factor
+            tier += 1
+        return tier
+
+    def __deleted(self, segment):
+        return {doc_id for (doc_id, seq) in self.tombstones.items() if segment['seq'] < seq}
+
+    def __drop_tombstones(self):
+        ''' Forget tombstones that no longer apply to any segment.
+        '''
+        min_seq = min((u['seq'] for u in self.segments), default=self.seq)
+        self.tombstones = {k: v for (k, v) in self.tombstones.items() if v > min_seq}
+
+    def __remove_obsolete(self):
+        if self.active_queries == 0:
+            for segment_id in self.obsolete:
+                self.__remove_segment_files(segment_id)
+            self.obsolete = []
+
+    def __remove_segment_files(self, segment_id):
+        base_path = self.__segment_base_path(segment_id)
+        for extension in SEGMENT_FILE_EXTENSIONS:
+            file_cache.forget(base_path + extension)
+            if os.path.exists(base_path + extension):
+                os.remove(base_path + extension)
+
+    def __segment_base_path(self, segment_id):
+        return f'{self.base_dir}/{self.name}_{segment_id:06d}'
+
+    def __segment_index(self, segment_id):
+        base_path = self.__segment_base_path(segment_id)
+        return SortBasedIndex(base_path + '.lex', base_path + '.inf',
+                              positional=self.positional)
+
+    def __next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def __next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    @property
+    def manifest_path(self):
+        return f'{self.base_dir}/{self.name}.segments.json'
+
+    def __load_manifest(self):
+        self.segments = []
+        self.tombstones = {}
+        self.last_id = 0
+        self.seq = 0
+        if not os.path.exists(self.manifest_path):
+            return
+
+        with open(self.manifest_path, 'r') as fin:
+            manifest = json.load(fin)
+        self.segments = manifest['segments']
+        self.tombstones = {int(k): v for (k, v) in manifest['tombstones'].items()}
+        self.last_id = manifest['last_id']
+        self.seq = manifest['seq']
+
+    def __save_manifest(self):
+        manifest = {
+            'segments': self.segments,
+            'tombstones': self.tombstones,
+            'last_id': self.last_id,
+            'seq': self.seq,
+        }
+        with open(self.manifest_path + '.part', 'w') as fout:
+            json.dump(manifest, fout)
+        os.replace(self.manifest_path + '.part', self.manifest_path)
+
+
+class SegmentView:
+    ''' A segment as seen by the query evaluation, with its deleted
+        documents hidden.
+    '''
+
+    def __init__(self, index, deleted):
+        self.index = index
+        self.deleted = deleted
+
+    def term_cursor(self, term, positions=False):
+        cursor = self.index.term_cursor(term, positions)
+        if cursor is None or not self.deleted:
+            return cursor
+        return FilteredCursor(cursor, self.deleted)
+
+    def expand_prefix(self, prefix, limit):
+        return self.index.expand_prefix(prefix, limit)
+
+    def expand_fuzzy(self, word, max_distance, limit):
+        return self.index.expand_fuzzy(word, max_distance, limit)
+
+    def doc_stats(self):
+        return self.index.doc_stats()
+
+    def live_totals(self):
+        ''' Doc count and total length of the documents not deleted.
+        '''
+        stats = self.index.doc_stats()
+        (doc_count, total_length) = (stats.doc_count, stats.total_length)
+        for doc_id in self.deleted:
+            length = stats.length(doc_id)
+            if length > 0:
+                doc_count -= 1
+                total_length -= length
+        return (doc_count, total_length)
+
+    def document_frequency(self, term):
+        df = self.index.document_frequency(term)
+        if df == 0 or not self.deleted:
+            return df
+        doc_ids = np.asarray(self.index.postings(term)[0])
+        deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        return df - int(np.isin(doc_ids, deleted).sum())
+
+
+class FilteredCursor:
+    ''' Cursor skipping the given doc ids, everything else is delegated to
+        the wrapped cursor.
+    '''
+
+    def __init__(self, cursor, deleted):
+        self.cursor = cursor
+        self.deleted = deleted
+        self.df = cursor.df
+        self.max_impact = cursor.max_impact
+        self.doc = self.__skip(cursor.doc)
+
+    def next(self):
+        self.doc = self.__skip(self.cursor.next())
+        return self.doc
+
+    def advance(self, target):
+        self.doc = self.__skip(self.cursor.advance(target))
+        return self.doc
+
+    def __skip(self, doc):
+        while doc in self.deleted:
+            doc = self.cursor.next()
+        return doc
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
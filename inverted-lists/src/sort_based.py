@@ -1,266 +1,711 @@
 import os
-import math
-import struct
+import mmap
+import heapq
 import shutil
-import pickle
-
-ENTRY_FORMAT_TMP = '=III'
-ENTRY_FORMAT_INF = '=II'
-RUN_SIZE = 4
+import struct
+from array import array
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import postings
+from . import cache
+from . import fuzzy
+from . import suggest
+from .lexicon import write_lexicon, open_lexicon
+from .query import evaluate, MAX_EXPANSIONS
+from .ranking import write_doc_stats, open_doc_stats, posting_impacts, top_k
+from .postings import ENTRY_FORMAT_INF
+
+# Tmp file entries are big-endian, so comparing two packed entries byte by
+# byte gives the order of their (term_id, doc_id, freq) tuples.
+ENTRY_FORMAT_TMP = '>III'
+# The same entries as NumPy records, runs are sorted and merged as whole
+# arrays of them.
+ENTRY_DTYPE_TMP = np.dtype([('term_id', '>u4'), ('doc_id', '>u4'), ('freq', '>u4')])
+# Entries of positional builds also carry the offset of the term positions
+# in the positions tmp file.
+ENTRY_DTYPE_TMP_POS = np.dtype(ENTRY_DTYPE_TMP.descr + [('offset', '>u8')])
+# Memory available for sorting runs while the tmp file is being written.
+MAX_RUN_BYTES = 256 * 1024 * 1024
+# Memory held by an entry of a run being sorted on top of its fields being
+# collected, its record and the sorted copy of the record: the sort key and
+# the position in the sorted order.
+SORT_ENTRY_OVERHEAD = 16
+# Number of documents tokenized by a worker at once in the parallel build.
+DOCS_PER_SHARD = 5000
+# Max number of runs merged at once; each one holds an open file and a buffer.
+MERGE_FAN_IN = 64
+# Number of entries fetched by a single read/write when merging runs.
+MERGE_BUFFER_ENTRIES = 16 * 1024
+# Number of values stored in the lexicon per term for each postings format.
+LEXICON_FIELDS = {
+    postings.FORMAT_V1: 2,  # count, pos
+    postings.FORMAT_V2: 3,  # count, pos, size
+    postings.FORMAT_V3: 4,  # count, pos, size, max impact
+    postings.FORMAT_V4: 4,  # count, pos, size, max impact
+}
+# Positional indexes add these to the lexicon fields: offset and size of
+# the term positions in the positions file.
+LEXICON_POSITIONS_FIELDS = 2
 
 
 class SortBasedIndex:
 
-    def __init__(self, lexicon_path: str, inverted_file_path: str, tmp_file: str = None):
+    def __init__(self, lexicon_path: str, inverted_file_path: str, tmp_file: str = None,
+                 max_run_bytes: int = MAX_RUN_BYTES, workers: int = 1,
+                 postings_format: int = postings.FORMAT_V4, positional: bool = False,
+                 postings_cache: cache.PostingsCache = cache.postings_cache):
         self.lexicon_path = lexicon_path
         self.inverted_file_path = inverted_file_path
         self.tmp_file = tmp_file if tmp_file is not None else inverted_file_path + '.tmp'
+        self.max_run_bytes = max_run_bytes
+        self.workers = workers
+        self.postings_format = postings_format
+        self.positional = positional
+        # decoded lists of hot terms, None reads every list from the file
+        self.postings_cache = postings_cache
+        self.doc_stats_path = os.path.splitext(inverted_file_path)[0] + '.dls'
+        self.positions_path = os.path.splitext(inverted_file_path)[0] + '.pos'
+        self.trigrams_path = os.path.splitext(inverted_file_path)[0] + '.tri'
+        self.suggestions_path = os.path.splitext(inverted_file_path)[0] + '.sug'
+        self.entry_dtype = ENTRY_DTYPE_TMP_POS if positional else ENTRY_DTYPE_TMP
 
     def create_invreted_file(self, docs):
-        index = {}
-        temp_file = ''
-        term_id = 0
-
-        tmp_file = open(self.tmp_file, 'wb')
-
-        def get_term_id(term):
-            nonlocal term_id
-            if term not in index:
-                term_id += 1
-                index[term] = term_id
-            return index[term]
-
-        # -2- write frequencies to tmp file
-
-        doc_count = 0
-        entry_count = 0
-        for doc in docs:
-            doc_count += 1
-            stats = self.__extract_doc_terms(doc.content)
-            for (term, freq) in stats.items():
-                _term_id = get_term_id(term)
-                entry = self.__freq_entry_pack(_term_id, doc.id, freq)
-                tmp_file.write(entry)
-                entry_count += 1
-        tmp_file.close()
-
-        # tmp_file_size = os.path.getsize(self.tmp_file)
-        # print(f'- size of tmp file: {tmp_file_size}')
-
-        # -3- internal (in-file) sorting of runs
+        # -2- write frequencies to tmp file as sorted runs
         # ASC term_id + ASC doc_id
-        # n records = 1 run. Read 1 run sort it and write it back.
 
-        with open(self.tmp_file, 'r+b') as fin:
-            entry_size = self.__freq_entry_size()
-            while True:
-                run_bytes = fin.read(entry_size * RUN_SIZE)
-                bytes_read = len(run_bytes)
-                if bytes_read == 0:
-                    break
+        with open(self.tmp_file, 'wb') as fout:
+            if self.workers > 1:
+                (index, runs, doc_lengths) = self.__write_runs_parallel(docs, fout)
+            else:
+                (index, runs, doc_lengths) = self.__write_runs_serial(docs, fout)
 
-                run = self.__freq_entry_run_unpack(run_bytes)
-                # sort in-place (as opposed to using sorted())
-                # print('--', len(run), run)
-                run.sort(key=lambda u: (u[0], u[1]))
-                # print('  ', len(run), run)
+        # -3- merge sorted runs
+        self.__merge_runs(runs)
 
-                # -- rewind back and write sorted run
-                run_bytes = self.__pack_run(run)
-                # print(f'R: {bytes_read}; W: {len(run_bytes)}')
-                fin.seek(-bytes_read, os.SEEK_CUR)
-                fin.write(run_bytes)
+        # -4- construct the inverted file, the lexicon and doc stats
+        positions_tmp = self.__open_positions_tmp() if self.positional else None
+        lexicon = self._write_index(
+            self.__read_terms(index, positions_tmp), doc_lengths)
+        os.remove(self.tmp_file)
+        if self.positional:
+            if hasattr(positions_tmp, 'close'):
+                positions_tmp.close()
+            os.remove(self.tmp_file + '.pos')
 
-        # -4- merge sorted runs
-        self.__merge_runs(entry_count)
+        print(f'= Ready with {len(doc_lengths)} docs and {len(lexicon.keys())} terms')
 
-        # -5- construct the inverted file
-        lexicon = self.__construct_inverted_file(index)
-        os.remove(self.tmp_file)
+        return lexicon
 
-        # -6- persist the lexicon file
-        with open(self.lexicon_path, 'wb') as fout:
-            pickle.dump(lexicon, fout)
+    def merge_indexes(self, sources):
+        ''' Build this index out of other indexes given as (index, deleted
+            doc ids) pairs, leaving out postings of the deleted documents.
+            A live doc id must not appear in more than one source.
+        '''
+        doc_lengths = {}
+        for (index, deleted) in sources:
+            stats = index.doc_stats()
+            for (doc_id, length) in zip(stats.doc_ids, stats.lengths):
+                if doc_id not in deleted:
+                    doc_lengths[doc_id] = length
 
-        print(f'= Ready with {doc_count} docs and {len(lexicon.keys())} terms')
+        lexicon = self._write_index(self.__merge_terms(sources), doc_lengths)
+
+        print(f'= Merged {len(sources)} indexes into {len(doc_lengths)} docs and {len(lexicon.keys())} terms')
 
         return lexicon
 
     def retrieve_docs(self, terms):
-        terms = terms.lower()
-        with open(self.lexicon_path, 'rb') as fin:
-            lexicon = pickle.load(fin)
-        entry = lexicon.get(terms, None)
-        if entry is None:
-            return []
-
-        (freq, pos) = entry
-        with open(self.inverted_file_path, 'rb') as fin:
-            entry_size = struct.calcsize(ENTRY_FORMAT_INF)
-            size = entry_size * freq
-            fin.seek(pos)
-            list_raw = fin.read(size)
-            list_ids = [struct.unpack(ENTRY_FORMAT_INF, list_raw[u: u + entry_size])
-                        for u in range(0, size, entry_size)]
-            # TODO: sort docs somehow
-
-            # Return doc ids
-            return list(map(lambda u: u[0], list_ids))
-
-    def __extract_doc_terms(self, content):
-        ''' Construct a dictonary mappind text terms to their frequency.
-            Terms are normalized first, as of now only lower-cased.
+        ''' Return ids of the documents matching a boolean query, see
+            query.py for the syntax.
         '''
-        stats = {}
-        for word in content.split():
-            word = word.lower()
-            if word in stats:
-                stats[word] += 1
-            else:
-                stats[word] = 1
-        return stats
+        return list(self.search(terms))
 
-    def __freq_entry_pack(self, term_id, doc_id, freq):
-        '''Construct a bytearray that consists of the three given argyments.
+    def rank(self, query, k=20, collection=None):
+        ''' Return the k best documents matching a query as (doc_id, score)
+            pairs ordered by their BM25 score, see ranking.top_k for the
+            collection statistics.
         '''
-        bytes = struct.pack(ENTRY_FORMAT_TMP, term_id, doc_id, freq)
-        return bytes
-
-    def __freq_entry_size(self):
-        return struct.calcsize(ENTRY_FORMAT_TMP)
-
-    def __freq_entry_run_unpack(self, bytes):
-        # bytes = struct.unpack(ENTRY_FORMAT_TMP, bytes)
-        entry_size = self.__freq_entry_size()
-        run = [bytes[i:i+entry_size] for i in range(0, len(bytes), entry_size)]
-        run = [u for u in map(
-            lambda u: struct.unpack(ENTRY_FORMAT_TMP, u), run)]
-        return run
-
-    def __pack_run(self, run):
-        result = bytearray()
-        for u in run:
-            result += bytearray(self.__freq_entry_pack(u[0], u[1], u[2]))
-        return result
-
-    def __merge_runs(self, entry_count):
-        # print(f'- merging for {entry_count} terms')
-        run_size = RUN_SIZE
-
-        # Number of runs can be oneven in the beginning, but it will not pose
-        # a problem because at some point run_count will be
-        # sufficiently large to form a pair.
-        while run_size < entry_count:
-            self.__run_merge_step_phase(run_size, entry_count)
-            run_size *= 2
-
-    def __run_merge_step_phase(self, run_size, entry_count):
-        # print(f'\n-- run of size {run_size}')
-        runs_count = math.ceil(entry_count / run_size)
-        # operating by run index is simpler than directly by term index
-        left = [i for i in range(0, runs_count, 2)]
-        right = [i for i in range(1, runs_count, 2)]
-        pairs = zip(left, right)
-
-        out_filename = self.tmp_file + '_aux'
-        shutil.copy(self.tmp_file, out_filename)
+        return top_k(query, self, k, collection)
 
-        entry_size = self.__freq_entry_size()
-        with open(self.tmp_file, 'rb') as fin:
-            # open for writing but do not truncate
-            with open(out_filename, 'r+b') as fout:
-                for p in pairs:
-                    l_b, l_e = (p[0] * run_size, (p[0] + 1) * run_size)
-                    r_b, r_e = (p[1] * run_size, (p[1] + 1) * run_size)
-                    r_e = min(r_e, entry_count)
-                    # print(p, l_b, l_e, r_b, r_e)
-                    pL = l_b
-                    pR = r_b
-                    pO = l_b
-
-                    fout.seek(pO * entry_size)
-
-                    while pL < l_e or pR < r_e:
-                        # print(f'- {pL}:{l_e} {pR}:{r_e}')
-                        if pL >= l_e:
-                            while pR < r_e:
-                                fin.seek(pR * entry_size)
-                                entry_bytes = fin.read(entry_size)
-                                fout.write(entry_bytes)
-                                pR += 1
-                        elif pR >= r_e:
-                            while pL < l_e:
-                                fin.seek(pL * entry_size)
-                                entry_bytes = fin.read(entry_size)
-                                fout.write(entry_bytes)
-                                pL += 1
-                        else:
-                            fin.seek(pL * entry_size)
-                            l_entry_bytes = fin.read(entry_size)
-                            l_entry = struct.unpack(
-                                ENTRY_FORMAT_TMP, l_entry_bytes)
-                            fin.seek(pR * entry_size)
-                            r_entry_bytes = fin.read(entry_size)
-                            # print('- ', pR, len(r_entry_bytes), fin.tell())
-                            r_entry = struct.unpack(
-                                ENTRY_FORMAT_TMP, r_entry_bytes)
-                            if l_entry[0] < r_entry[0] or (l_entry[0] == r_entry[0] and l_entry[1] <= r_entry[1]):
-                                fout.write(l_entry_bytes)
-                                pL += 1
-                            else:
-                                fout.write(r_entry_bytes)
-                                pR += 1
-        os.rename(out_filename, self.tmp_file)
-
-    def __construct_inverted_file(self, term_index):
-        pos_to_term = {i: k for (k, i) in term_index.items()}
-        lexicon = {}
-
-        entry_size = self.__freq_entry_size()
+    def search(self, query):
+        ''' Stream ids of the documents matching a boolean query.
+        '''
+        return evaluate(query, self)
 
-        with open(self.inverted_file_path, 'wb') as fout:
-            with open(self.tmp_file, 'rb') as fin:
-                entry_prev = struct.unpack(
-                    ENTRY_FORMAT_TMP, fin.read(entry_size))
-                entry_count = 1
-                term_list_size = 1
+    def term_cursor(self, term, positions=False):
+        ''' Open a cursor over the postings list of a term, None when the
+            term is not in the lexicon. With positions the cursor also gives
+            access to the term positions in the current document, unless the
+            index was built without them.
+        '''
+        entry = open_lexicon(self.lexicon_path).get(term, None)
+        if entry is None:
+            return None
+
+        reader = postings.open_postings(self.inverted_file_path)
+        format = reader.format
+        max_impact = entry[3] if format in postings.IMPACT_FORMATS else None
+        decoded = self.__cached_list(term, reader, entry)
+        if decoded is not None:
+            cursor = postings.ArrayCursor(*decoded[:2], max_impact, *decoded[2:])
+        else:
+            cursor = postings.open_cursor(
+                self.__list_bytes(reader, entry), entry[0], format, max_impact)
+
+        fields = LEXICON_FIELDS[format]
+        if positions and len(entry) == fields + LEXICON_POSITIONS_FIELDS:
+            (positions_pos, positions_size) = entry[fields:]
+            positions_reader = postings.open_postings(self.positions_path)
+            cursor = postings.PositionalCursor(
+                cursor, positions_reader.slice(positions_pos, positions_size))
+        return cursor
+
+    def expand_prefix(self, prefix, limit=MAX_EXPANSIONS):
+        ''' The limit most frequent terms starting with prefix. The sorted
+            lexicon is scanned from the first block that can hold them, so
+            the cost is O(log V + matches).
+        '''
+        lexicon = open_lexicon(self.lexicon_path)
+        if isinstance(lexicon, dict):
+            matches = ((k, v) for (k, v) in lexicon.items() if k.startswith(prefix))
+        else:
+            matches = lexicon.prefix_items(prefix)
+        return [u[0] for u in heapq.nlargest(limit, matches, key=lambda u: u[1][0])]
+
+    def expand_fuzzy(self, word, max_distance=None, limit=MAX_EXPANSIONS):
+        ''' Terms within max_distance edits of the word, closest and then
+            most frequent first. Candidates come from the trigram index, an
+            index built without one has no fuzzy matches.
+        '''
+        lexicon = open_lexicon(self.lexicon_path)
+        if isinstance(lexicon, dict) or not os.path.exists(self.trigrams_path):
+            return []
+        if max_distance is None:
+            max_distance = fuzzy.default_distance(word)
+
+        matches = []
+        trigrams = fuzzy.open_trigrams(self.trigrams_path)
+        for ordinal in trigrams.candidates(word, max_distance):
+            term = lexicon.term_at(ordinal)
+            distance = fuzzy.edit_distance(word, term, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, -lexicon.get(term)[0], term))
+        return [u[2] for u in sorted(matches)[:limit]]
+
+    def suggest(self, prefix, k=suggest.SUGGESTIONS):
+        ''' The k most frequent terms starting with prefix as (term, df)
+            pairs.
+        '''
+        return suggest.complete(self.suggestions_path, self.lexicon_path, prefix, k)
 
-                lexicon[pos_to_term[entry_prev[0]]] = 0
+    def postings(self, term):
+        ''' Return the postings list of a term as (doc_ids, freqs) arrays,
+            both empty when the term is not in the lexicon.
+        '''
+        entry = open_lexicon(self.lexicon_path).get(term, None)
+        if entry is None:
+            return (array('I'), array('I'))
+
+        reader = postings.open_postings(self.inverted_file_path)
+        decoded = self.__cached_list(term, reader, entry)
+        if decoded is not None:
+            return decoded[:2]
+        return postings.decode_arrays(self.__list_bytes(reader, entry), reader.format)
+
+    def __cached_list(self, term, reader, entry):
+        ''' Decoded (doc_ids, freqs, block_lasts, block_impacts) of a hot
+            term from the postings cache, None when the list is read from
+            the file instead. v1 lists are never cached, they are decoded
+            without copying anyway.
+        '''
+        if self.postings_cache is None or reader.format == postings.FORMAT_V1:
+            return None
+
+        def decode():
+            buf = self.__list_bytes(reader, entry)
+            blocks = postings.decode_skip_table(buf, reader.format)
+            block_impacts = None
+            if reader.format in postings.IMPACT_FORMATS:
+                block_impacts = array('I', (u[4] for u in blocks))
+            return (*postings.decode_arrays(buf, reader.format),
+                    array('I', (u[1] for u in blocks)), block_impacts)
+
+        key = (self.inverted_file_path, term)
+        generation = cache.index_generation([self.inverted_file_path])
+        return self.postings_cache.get(key, generation, entry[0], decode)
+
+    def __list_bytes(self, reader, entry):
+        (freq, pos) = entry[:2]
+        if reader.format == postings.FORMAT_V1:
+            size = struct.calcsize(ENTRY_FORMAT_INF) * freq
+        else:
+            size = entry[2]
+        return reader.slice(pos, size)
+
+    def doc_stats(self):
+        return open_doc_stats(self.doc_stats_path)
+
+    def document_frequency(self, term):
+        entry = open_lexicon(self.lexicon_path).get(term, None)
+        return entry[0] if entry is not None else 0
+
+    def __write_runs_serial(self, docs, fout):
+        ''' Tokenize the documents and write their entries to the tmp file
+            as sorted runs of as many entries as fit in max_run_bytes.
+            Returns the runs as (begin, end) entry indices.
+        '''
+        index = {}
+        doc_lengths = {}
+        positions_file = open(self.tmp_file + '.pos', 'wb') if self.positional else None
+        buffer = RunBuffer(index, positions_file)
+        capacity = self.__run_capacity()
+        runs = []
 
-                fout.write(struct.pack(ENTRY_FORMAT_INF,
-                                       entry_prev[1], entry_prev[2]))
+        def write_run():
+            begin = runs[-1][1] if runs else 0
+            runs.append((begin, begin + len(buffer)))
+            fout.write(buffer.take_sorted().tobytes())
 
+        for doc in docs:
+            doc_lengths[doc.id] = buffer.add(doc.id, doc.content)
+            if len(buffer) >= capacity:
+                write_run()
+        if len(buffer) > 0:
+            write_run()
+
+        if positions_file is not None:
+            positions_file.close()
+        return (index, runs, doc_lengths)
+
+    def __write_runs_parallel(self, docs, fout):
+        ''' Tokenize shards of documents in a process pool. Every worker
+            writes one sorted run using term ids local to its shard, which
+            are then mapped to global ids while the runs are copied to the
+            tmp file.
+
+            Local and global term ids are both assigned in lexical order of
+            the terms, so the mapping keeps every run sorted.
+        '''
+        results = []
+        with ProcessPoolExecutor(self.workers) as pool:
+            pending = set()
+            for (shard_no, shard) in enumerate(self.__shards_gen(docs)):
+                run_path = f'{self.tmp_file}.{shard_no}'
+                pending.add(pool.submit(build_shard_run, shard, run_path, self.positional))
+                # keep the number of shards held in memory bounded
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    results.extend(u.result() for u in done)
+            results.extend(u.result() for u in wait(pending).done)
+
+        vocabulary = set()
+        for (_, shard_terms, _) in results:
+            vocabulary.update(shard_terms)
+        index = {term: i + 1 for (i, term) in enumerate(sorted(vocabulary))}
+
+        runs = []
+        doc_lengths = {}
+        positions_file = open(self.tmp_file + '.pos', 'wb') if self.positional else None
+        for (run_path, shard_terms, shard_doc_lengths) in results:
+            doc_lengths.update(shard_doc_lengths)
+            term_ids = np.array([0] + [index[term] for term in shard_terms], dtype=np.uint32)
+            # positions of the shard are appended to the common positions
+            # tmp file, entry offsets are shifted accordingly
+            positions_base = 0
+            if positions_file is not None:
+                positions_base = positions_file.tell()
+                with open(run_path + '.pos', 'rb') as fin:
+                    shutil.copyfileobj(fin, positions_file)
+                os.remove(run_path + '.pos')
+            run_begin = runs[-1][1] if runs else 0
+            run_length = 0
+            with open(run_path, 'rb') as fin:
                 while True:
-                    bytes_read = fin.read(entry_size)
-                    if len(bytes_read) == 0:
+                    entries = np.fromfile(fin, dtype=self.entry_dtype, count=MERGE_BUFFER_ENTRIES)
+                    if len(entries) == 0:
                         break
+                    entries['term_id'] = np.take(term_ids, entries['term_id'])
+                    if positions_file is not None:
+                        entries['offset'] += positions_base
+                    fout.write(entries.tobytes())
+                    run_length += len(entries)
+            os.remove(run_path)
+            if run_length > 0:
+                runs.append((run_begin, run_begin + run_length))
+        if positions_file is not None:
+            positions_file.close()
+
+        return (index, runs, doc_lengths)
+
+    def __shards_gen(self, docs):
+        shard = []
+        for doc in docs:
+            shard.append((doc.id, doc.content))
+            if len(shard) == DOCS_PER_SHARD:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    def __run_capacity(self):
+        ''' Number of entries of a run sorted within max_run_bytes.
+        '''
+        return max(1, self.max_run_bytes // (3 * self.entry_dtype.itemsize + SORT_ENTRY_OVERHEAD))
+
+    def __merge_runs(self, runs):
+        ''' Merge sorted runs of the tmp file until a single run remains.
+            Every pass merges up to MERGE_FAN_IN neighbouring runs at once,
+            so the whole file is usually rewritten only once or twice.
+        '''
+        while len(runs) > 1:
+            runs = self.__run_merge_step_phase(runs)
+
+    def __run_merge_step_phase(self, runs):
+        ''' Perform a single k-way merge pass over the tmp file.
+            Runs are given as (begin, end) entry indices; the runs of the
+            rewritten file are returned.
+        '''
+        out_filename = self.tmp_file + '_aux'
+        merged_runs = []
+
+        with open(out_filename, 'wb') as fout:
+            for i in range(0, len(runs), MERGE_FAN_IN):
+                group = runs[i:i + MERGE_FAN_IN]
+                for entries in self.__merge_group(group):
+                    fout.write(entries.tobytes())
+                merged_runs.append((group[0][0], group[-1][1]))
+
+        os.replace(out_filename, self.tmp_file)
+        return merged_runs
+
+    def __merge_group(self, group):
+        ''' Merge runs a chunk of entries at a time. Every run has a chunk
+            read ahead; no entry left unread can precede the last entry of
+            the chunk having the smallest one, so the entries of all chunks
+            up to it are sorted together and given out as one array.
+        '''
+        heads = []
+        for (begin, end) in group:
+            reader = self.__read_run(begin, end)
+            entries = next(reader, None)
+            if entries is not None:
+                heads.append((reader, entries, entry_keys(entries)))
+
+        while heads:
+            bound = min(keys[-1] for (_, _, keys) in heads)
+            (parts, part_keys, next_heads) = ([], [], [])
+            for (reader, entries, keys) in heads:
+                count = np.searchsorted(keys, bound, side='right')
+                parts.append(entries[:count])
+                part_keys.append(keys[:count])
+                if count < len(entries):
+                    next_heads.append((reader, entries[count:], keys[count:]))
+                    continue
+                entries = next(reader, None)
+                if entries is not None:
+                    next_heads.append((reader, entries, entry_keys(entries)))
+            heads = next_heads
+
+            # concatenating records would turn them to native byte order
+            entries = np.concatenate(parts, dtype=self.entry_dtype)
+            # runs come out of the heads as sorted sequences, which the
+            # stable sort merges rather than sorting them from scratch
+            yield entries[np.argsort(np.concatenate(part_keys), kind='stable')]
+
+    def __read_run(self, begin, end):
+        ''' Iterate over chunks of entries of a single sorted run of the tmp
+            file. Each run gets its own file handle so reads stay sequential.
+        '''
+        with open(self.tmp_file, 'rb') as fin:
+            fin.seek(begin * self.entry_dtype.itemsize)
+            remaining = end - begin
+            while remaining > 0:
+                count = min(remaining, MERGE_BUFFER_ENTRIES)
+                yield np.fromfile(fin, dtype=self.entry_dtype, count=count)
+                remaining -= count
+
+    def _write_index(self, terms, doc_lengths):
+        ''' Write the inverted file, the positions file, the lexicon and the
+            doc stats. Terms are given as (term, postings, position records)
+            triples, postings being (doc_id, freq) pairs sorted by doc_id.
+            Position records are only needed by positional indexes.
+        '''
+        writer = InvertedFileWriter(
+            self.inverted_file_path,
+            self.positions_path if self.positional else None,
+            doc_lengths,
+            self.postings_format)
+        for (term, term_postings, position_records) in terms:
+            writer.add(term, term_postings, position_records)
+        lexicon = writer.close()
+
+        fields = LEXICON_FIELDS[self.postings_format]
+        if self.positional:
+            fields += LEXICON_POSITIONS_FIELDS
+        write_lexicon(self.lexicon_path, lexicon, fields)
+        fuzzy.write_trigrams(self.trigrams_path, sorted(lexicon.keys()))
+        suggest.write_suggestions(self.suggestions_path, lexicon)
+
+        write_doc_stats(self.doc_stats_path, doc_lengths)
 
-                    entry = struct.unpack(ENTRY_FORMAT_TMP, bytes_read)
+        return lexicon
 
-                    if entry_prev[0] != entry[0]:
-                        # update prev record with count and pos
-                        pos = lexicon[pos_to_term[entry_prev[0]]]
-                        lexicon[pos_to_term[entry_prev[0]]] = (
-                            term_list_size, pos)
-                        # start current record with pos
-                        lexicon[pos_to_term[entry[0]]] = fout.tell()
-                        # reset term count
-                        term_list_size = 1
-                    else:
-                        term_list_size += 1
-                    entry_count += 1
+    def __merge_terms(self, sources):
+        ''' Merge postings of the source indexes term by term.
+        '''
+        lexicons = [open_lexicon(index.lexicon_path) for (index, _) in sources]
+        terms = heapq.merge(*[(u[0] for u in lexicon.items()) for lexicon in lexicons])
+
+        prev_term = None
+        for term in terms:
+            if term == prev_term:
+                continue
+            prev_term = term
+
+            lists = []
+            for (index, deleted) in sources:
+                cursor = index.term_cursor(term, positions=self.positional)
+                if cursor is None:
+                    continue
+                if self.positional and not hasattr(cursor, 'record'):
+                    raise ValueError('Positional index can not be merged from indexes without positions.')
+                entries = []
+                while cursor.doc != postings.END_OF_LIST:
+                    if cursor.doc not in deleted:
+                        record = cursor.record() if self.positional else None
+                        entries.append((cursor.doc, cursor.freq, record))
+                    cursor.next()
+                lists.append(entries)
+
+            term_entries = list(heapq.merge(*lists, key=lambda u: u[0]))
+            if not term_entries:
+                continue
+            term_postings = [u[:2] for u in term_entries]
+            position_records = [u[2] for u in term_entries] if self.positional else None
+            yield (term, term_postings, position_records)
+
+    def __read_terms(self, term_index, positions_tmp):
+        ''' Group the sorted entries of the tmp file by term. The postings
+            of a term are given as an array of (doc_id, freq) rows.
+        '''
+        pos_to_term = {i: k for (k, i) in term_index.items()}
 
-                    fout.write(struct.pack(
-                        ENTRY_FORMAT_INF, entry[1], entry[2]))
+        def group(parts):
+            entries = np.concatenate(parts)
+            term_postings = np.stack((entries['doc_id'], entries['freq']), axis=1).astype(np.int64)
+            position_records = None
+            if positions_tmp is not None:
+                position_records = [postings.read_positions_record(positions_tmp, u)
+                                    for u in entries['offset'].tolist()]
+            return (pos_to_term[int(entries['term_id'][0])], term_postings, position_records)
 
-                    entry_prev = entry
+        with open(self.tmp_file, 'rb') as fin:
+            # entries of the last term read, it may go on in the next chunk
+            held = []
 
-                # update last record with count and pos
-                pos = lexicon[pos_to_term[entry_prev[0]]]
-                lexicon[pos_to_term[entry_prev[0]]] = (term_list_size, pos)
-            fout.flush()
+            while True:
+                entries = np.fromfile(fin, dtype=self.entry_dtype, count=MERGE_BUFFER_ENTRIES)
+                if len(entries) == 0:
+                    break
 
-        return lexicon
+                term_ids = entries['term_id']
+                starts = (np.flatnonzero(term_ids[1:] != term_ids[:-1]) + 1).tolist()
+                for (begin, end) in zip([0] + starts, starts + [len(entries)]):
+                    if held and held[0]['term_id'][0] != term_ids[begin]:
+                        yield group(held)
+                        held = []
+                    held.append(entries[begin:end])
+
+            if held:
+                yield group(held)
+
+    def __open_positions_tmp(self):
+        with open(self.tmp_file + '.pos', 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class InvertedFileWriter:
+    ''' Appends postings lists, one term at a time, to the inverted file and
+        the positions file and collects the lexicon entries of the terms,
+        see LEXICON_FIELDS.
+    '''
+
+    def __init__(self, inverted_file_path, positions_path, doc_lengths, postings_format):
+        self.doc_lengths = doc_lengths
+        self.avg_length = sum(doc_lengths.values()) / max(len(doc_lengths), 1)
+        # doc lengths as sorted arrays, looked up for whole lists at once
+        self.doc_ids = np.array(sorted(doc_lengths.keys()), dtype=np.int64)
+        self.lengths = np.array([doc_lengths[u] for u in self.doc_ids.tolist()], dtype=np.int64)
+        self.postings_format = postings_format
+        self.lexicon = {}
+
+        # files are written next to their targets and swapped in on close,
+        # readers may still have the old ones mapped
+        self.paths = [inverted_file_path]
+        self.file = open(inverted_file_path + '.part', 'wb')
+        self.file.write(postings.header(postings_format))
+        self.positions_file = None
+        if positions_path is not None:
+            self.paths.append(positions_path)
+            self.positions_file = open(positions_path + '.part', 'wb')
+
+    def add(self, term, term_postings, position_records=None):
+        pos = self.file.tell()
+        pairs = np.asarray(term_postings, dtype=np.int64).reshape(-1, 2)
+        # the v4 encoder takes the array as it is, older ones walk the pairs
+        term_postings = pairs if self.postings_format == postings.FORMAT_V4 else pairs.tolist()
+        impacts = None
+        if self.postings_format in postings.IMPACT_FORMATS:
+            lengths = self.lengths[np.searchsorted(self.doc_ids, pairs[:, 0])]
+            impacts = posting_impacts(pairs[:, 1], lengths, len(self.doc_lengths), self.avg_length)
+        list_raw = postings.encode_postings(
+            term_postings, self.postings_format, impacts)
+        self.file.write(list_raw)
+
+        if self.postings_format == postings.FORMAT_V1:
+            entry = (len(term_postings), pos)
+        elif self.postings_format == postings.FORMAT_V2:
+            entry = (len(term_postings), pos, len(list_raw))
+        else:
+            entry = (len(term_postings), pos, len(list_raw), int(impacts.max()))
+
+        if self.positions_file is not None:
+            positions_pos = self.positions_file.tell()
+            self.positions_file.write(b''.join(position_records))
+            entry += (positions_pos, self.positions_file.tell() - positions_pos)
+
+        self.lexicon[term] = entry
+
+    def close(self):
+        self.file.close()
+        if self.positions_file is not None:
+            self.positions_file.close()
+        for path in self.paths:
+            os.replace(path + '.part', path)
+        return self.lexicon
+
+
+def extract_doc_terms(content):
+    ''' Construct a dictonary mappind text terms to their frequency.
+        Terms are normalized first, as of now only lower-cased.
+    '''
+    stats = {}
+    for word in content.split():
+        word = word.lower()
+        if word in stats:
+            stats[word] += 1
+        else:
+            stats[word] = 1
+    return stats
+
+
+def extract_doc_positions(content):
+    ''' Construct a dictonary mapping text terms to the list of their
+        positions (word offsets) in the content.
+    '''
+    stats = {}
+    for (position, word) in enumerate(content.split()):
+        word = word.lower()
+        if word in stats:
+            stats[word].append(position)
+        else:
+            stats[word] = [position]
+    return stats
+
+
+class RunBuffer:
+    ''' Entries of a run of the tmp file collected while documents are
+        tokenized. Their fields are kept in flat arrays until the run is
+        taken as a sorted array of records. Terms missing from the term
+        index get the next id. Positional builds write the term positions to
+        positions_file as they come.
+    '''
+
+    def __init__(self, term_index, positions_file=None):
+        self.term_index = term_index
+        self.positions_file = positions_file
+        self.positions_offset = 0
+        self.dtype = ENTRY_DTYPE_TMP if positions_file is None else ENTRY_DTYPE_TMP_POS
+        # term ids, doc ids, freqs and positions offsets
+        self.fields = [array('I'), array('I'), array('I'), array('Q')][:len(self.dtype.names)]
+
+    def __len__(self):
+        return len(self.fields[0])
+
+    def add(self, doc_id, content):
+        ''' Add the entries of a document, returns its length in terms.
+        '''
+        (term_ids, doc_ids, freqs) = self.fields[:3]
+        if self.positions_file is None:
+            stats = extract_doc_terms(content)
+            freqs.extend(stats.values())
+            length = sum(stats.values())
+        else:
+            stats = extract_doc_positions(content)
+            length = 0
+            for positions in stats.values():
+                positions_raw = postings.encode_positions(positions)
+                self.positions_file.write(positions_raw)
+                self.fields[3].append(self.positions_offset)
+                self.positions_offset += len(positions_raw)
+                freqs.append(len(positions))
+                length += len(positions)
+
+        index = self.term_index
+        term_ids.extend([index.setdefault(term, len(index) + 1) for term in stats])
+        doc_ids.extend(repeat(doc_id, len(stats)))
+        return length
+
+    def take_sorted(self, term_ids=None):
+        ''' Empty the buffer, returning its entries as a sorted array of
+            records. term_ids maps the term ids of the buffer to the ones
+            written, when given.
+        '''
+        entries = np.empty(len(self), dtype=self.dtype)
+        for (name, values) in zip(self.dtype.names, self.fields):
+            entries[name] = values
+            del values[:]
+        if term_ids is not None:
+            entries['term_id'] = np.take(term_ids, entries['term_id'])
+        return entries[np.argsort(entry_keys(entries), kind='stable')]
+
+
+def entry_keys(entries):
+    ''' Sort keys of an array of tmp entries. A term occurs once in a
+        document, so the (term_id, doc_id) pairs alone order the entries.
+    '''
+    return (entries['term_id'].astype(np.uint64) << np.uint64(32)) | entries['doc_id']
+
+
+def build_shard_run(shard, run_path, positional=False):
+    ''' Worker side of the parallel build. Tokenize a shard of
+        (doc_id, content) pairs and write its entries as a single sorted
+        run. Term ids are local to the shard and follow the lexical order
+        of its terms; the sorted terms are returned along with the run path
+        and the (doc_id, length) pairs of the shard documents.
+        Positional builds write the term positions to run_path + '.pos'.
+    '''
+    index = {}
+    positions_file = open(run_path + '.pos', 'wb') if positional else None
+    buffer = RunBuffer(index, positions_file)
+    doc_lengths = [(doc_id, buffer.add(doc_id, content)) for (doc_id, content) in shard]
+    if positions_file is not None:
+        positions_file.close()
+
+    # ids were given in order of appearance, map them to the lexical order
+    shard_terms = sorted(index)
+    term_ids = np.zeros(len(index) + 1, dtype=np.uint32)
+    term_ids[[index[term] for term in shard_terms]] = np.arange(1, len(index) + 1)
+
+    with open(run_path, 'wb') as fout:
+        fout.write(buffer.take_sorted(term_ids).tobytes())
+
+    return (run_path, shard_terms, doc_lengths)
 
 
 def ensure_tmp_file_is_sorted(temp_file_path):
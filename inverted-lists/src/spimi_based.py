@@ -0,0 +1,143 @@
+''' Single-pass in-memory indexing (SPIMI).
+
+    Postings are accumulated per term in a MemoryIndex until the memory
+    budget is used up, the block is then written to disk with its terms
+    in sorted order. Blocks are finally merged term by term into the same
+    inverted file and lexicon SortBasedIndex writes, so the resulting index
+    is queried through SortBasedIndex. No tmp file of single postings is
+    written and nothing is sorted globally.
+
+    A block file holds, for every term in sorted order:
+
+        header  (term length, document frequency)
+        bytes   term
+        array   of doc ids
+        array   of frequencies
+'''
+import os
+import heapq
+import struct
+from array import array
+
+from . import postings
+from .memory_based import MemoryIndex
+from .sort_based import SortBasedIndex
+
+BLOCK_TERM_FORMAT = '=II'
+# Memory available for the postings of a block.
+MAX_BLOCK_BYTES = 256 * 1024 * 1024
+# Approximate memory held by a single posting, a term and a doc length.
+POSTING_SIZE = 8
+TERM_ENTRY_SIZE = 200
+DOC_ENTRY_SIZE = 8
+
+
+class SpimiIndex(SortBasedIndex):
+
+    def __init__(self, lexicon_path: str, inverted_file_path: str, tmp_file: str = None,
+                 memory_budget: int = MAX_BLOCK_BYTES,
+                 postings_format: int = postings.FORMAT_V4, **kwargs):
+        if kwargs.get('positional', False):
+            raise ValueError('SPIMI builds do not keep positions, use SortBasedIndex.')
+        super().__init__(lexicon_path, inverted_file_path, tmp_file,
+                         postings_format=postings_format, **kwargs)
+        self.memory_budget = memory_budget
+
+    def create_invreted_file(self, docs):
+        # -1- accumulate postings in memory, spill sorted blocks to disk
+        doc_lengths = {}
+        block_paths = []
+        block = MemoryIndex()
+        ascending = True
+        prev_doc_id = -1
+
+        for doc in docs:
+            block.add_document(doc.id, doc.content)
+            ascending = ascending and doc.id > prev_doc_id
+            prev_doc_id = doc.id
+            if self.__block_size(block) >= self.memory_budget:
+                doc_lengths.update(zip(block.stats.doc_ids, block.stats.lengths))
+                block_paths.append(self.__write_block(block, len(block_paths)))
+                block = MemoryIndex()
+        doc_lengths.update(zip(block.stats.doc_ids, block.stats.lengths))
+
+        # -2- merge the blocks into the inverted file, the lexicon and doc
+        # stats; a single block never has to leave memory
+        if not block_paths:
+            terms = block.items()
+        else:
+            if block.posting_count > 0:
+                block_paths.append(self.__write_block(block, len(block_paths)))
+            terms = self.__merge_blocks(block_paths, ascending)
+        lexicon = self._write_index(
+            ((term, list(zip(doc_ids, freqs)), None) for (term, doc_ids, freqs) in terms),
+            doc_lengths)
+
+        for path in block_paths:
+            os.remove(path)
+
+        print(f'= Ready with {len(doc_lengths)} docs and {len(lexicon.keys())} terms')
+
+        return lexicon
+
+    def __block_size(self, block):
+        return (block.posting_count * POSTING_SIZE
+                + len(block.term_ids) * TERM_ENTRY_SIZE
+                + block.stats.doc_count * DOC_ENTRY_SIZE)
+
+    def __write_block(self, block, block_no):
+        path = f'{self.tmp_file}.{block_no}'
+        with open(path, 'wb') as fout:
+            for (term, doc_ids, freqs) in block.items():
+                term = term.encode()
+                fout.write(struct.pack(BLOCK_TERM_FORMAT, len(term), len(doc_ids)))
+                fout.write(term)
+                fout.write(doc_ids.tobytes())
+                fout.write(freqs.tobytes())
+        return path
+
+    def __merge_blocks(self, block_paths, ascending):
+        ''' Merge the postings of the blocks term by term. Blocks hold
+            consecutive documents, their lists are concatenated in block
+            order unless the documents came in no particular order.
+        '''
+        readers = [read_block(u) for u in block_paths]
+        merged = heapq.merge(*readers, key=lambda u: u[0])
+
+        term = None
+        doc_ids = freqs = None
+        for (block_term, block_doc_ids, block_freqs) in merged:
+            if block_term != term:
+                if term is not None:
+                    yield sorted_list(term, doc_ids, freqs, ascending)
+                (term, doc_ids, freqs) = (block_term, block_doc_ids, block_freqs)
+                continue
+            doc_ids.extend(block_doc_ids)
+            freqs.extend(block_freqs)
+        if term is not None:
+            yield sorted_list(term, doc_ids, freqs, ascending)
+
+
+def read_block(path):
+    ''' Iterate over (term, doc_ids, freqs) of a block file.
+    '''
+    header_size = struct.calcsize(BLOCK_TERM_FORMAT)
+    with open(path, 'rb', buffering=1024 * 1024) as fin:
+        while True:
+            header = fin.read(header_size)
+            if len(header) == 0:
+                break
+            (length, df) = struct.unpack(BLOCK_TERM_FORMAT, header)
+            term = fin.read(length).decode()
+            doc_ids = array('I')
+            doc_ids.frombytes(fin.read(df * doc_ids.itemsize))
+            freqs = array('I')
+            freqs.frombytes(fin.read(df * freqs.itemsize))
+            yield (term, doc_ids, freqs)
+
+
+def sorted_list(term, doc_ids, freqs, ascending):
+    if ascending:
+        return (term, doc_ids, freqs)
+    pairs = sorted(zip(doc_ids, freqs))
+    return (term, array('I', (u[0] for u in pairs)), array('I', (u[1] for u in pairs)))
@@ -0,0 +1,133 @@
+''' Query completions precomputed from the lexicon.
+
+    For every prefix of up to MAX_PREFIX_LENGTH characters of the lexicon
+    terms, the suggestions file keeps the SUGGESTIONS terms starting with
+    it that occur in the most documents:
+
+        magic
+        header  (prefix count)
+        array   of record offsets, one per prefix in sorted order
+        records of (varint prefix length, prefix, varint completion count,
+                (varint term length, term, varint df) per completion)
+
+    A lookup is a binary search over the offset array, the postings are
+    never touched. Longer prefixes match few terms, those are completed
+    by a range scan of the lexicon instead.
+'''
+import os
+import mmap
+import heapq
+import struct
+from array import array
+
+from .postings import vbyte_encode, vbyte_decode
+from .lexicon import open_lexicon
+from .file_cache import open_cached
+
+MAGIC = b'SUG\x01'
+# prefix count
+HEADER_FORMAT = '=Q'
+MAX_PREFIX_LENGTH = 6
+SUGGESTIONS = 10
+
+
+def write_suggestions(path, lexicon):
+    ''' Persist the completions of a dictionary mapping terms to lexicon
+        entries, the first value of an entry being the document frequency.
+    '''
+    top = {}
+    for (ordinal, term) in enumerate(sorted(lexicon.keys())):
+        # ties go to the term coming first in the lexicon
+        item = (lexicon[term][0], -ordinal, term)
+        for length in range(1, min(len(term), MAX_PREFIX_LENGTH) + 1):
+            heap = top.setdefault(term[:length].encode(), [])
+            if len(heap) < SUGGESTIONS:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    prefixes = sorted(top.keys())
+    offsets = array('Q')
+    records = bytearray()
+    begin = len(MAGIC) + struct.calcsize(HEADER_FORMAT) + len(prefixes) * offsets.itemsize
+    for prefix in prefixes:
+        offsets.append(begin + len(records))
+        vbyte_encode(len(prefix), records)
+        records += prefix
+        completions = sorted(top[prefix], reverse=True)
+        vbyte_encode(len(completions), records)
+        for (df, _, term) in completions:
+            term = term.encode()
+            vbyte_encode(len(term), records)
+            records += term
+            vbyte_encode(df, records)
+
+    with open(path + '.part', 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack(HEADER_FORMAT, len(prefixes)))
+        fout.write(offsets.tobytes())
+        fout.write(records)
+    os.replace(path + '.part', path)
+
+
+class Suggestions:
+
+    def __init__(self, path):
+        with open(path, 'rb') as fin:
+            self.data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a suggestions file.')
+        (self.prefix_count,) = struct.unpack_from(HEADER_FORMAT, self.data, len(MAGIC))
+        begin = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+        size = self.prefix_count * array('Q').itemsize
+        self.offsets = memoryview(self.data)[begin:begin + size].cast('Q')
+
+    def get(self, prefix):
+        ''' Completions of the prefix as (term, df) pairs, most frequent
+            first.
+        '''
+        prefix = prefix.encode()
+        (lo, hi) = (0, self.prefix_count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (key, pos) = self.__read_key(self.offsets[mid])
+            if key < prefix:
+                lo = mid + 1
+            elif key > prefix:
+                hi = mid
+            else:
+                return self.__read_completions(pos)
+        return []
+
+    def __read_key(self, pos):
+        (length, pos) = vbyte_decode(self.data, pos)
+        return (self.data[pos:pos + length], pos + length)
+
+    def __read_completions(self, pos):
+        (count, pos) = vbyte_decode(self.data, pos)
+        completions = []
+        for _ in range(count):
+            (term, pos) = self.__read_key(pos)
+            (df, pos) = vbyte_decode(self.data, pos)
+            completions.append((term.decode(), df))
+        return completions
+
+
+def open_suggestions(path):
+    return open_cached(path, Suggestions)
+
+
+def complete(suggestions_path, lexicon_path, prefix, k=SUGGESTIONS):
+    ''' The k most frequent terms starting with prefix as (term, df) pairs.
+        Indexes built without a suggestions file get none.
+    '''
+    prefix = prefix.lower()
+    if not prefix or not os.path.exists(suggestions_path):
+        return []
+    if len(prefix) <= MAX_PREFIX_LENGTH:
+        return open_suggestions(suggestions_path).get(prefix)[:k]
+
+    lexicon = open_lexicon(lexicon_path)
+    matches = ((term, values[0]) for (term, values) in lexicon.prefix_items(prefix))
+    return heapq.nlargest(k, matches, key=lambda u: u[1])